@@ -3,27 +3,34 @@ from bot_instance import bot, dp
 from config_data.config import settings
 from keyboards.deps import BackButton
 from logger_setup import logger
-from db.database import async_session
-from db.db_models import PaymentData, LinksOrm
+from db.database import async_session, dispose_engine
+from db.db_models import PaymentData
 from repositories.base import BaseRepository
-from misc.utils import get_links_of_panels, get_user, modify_user, new_date, create_user_sync, update_user_sync
-from marz.backend import MarzbanClient
+from misc.utils import get_links_of_panels, get_user, modify_user, new_date, calculate_expire
+from marz.backend import MarzbanClient, init_sessions, close_sessions
+from marz import health as panel_health
+from marz.events import process_batch
+from marz import outbox, stream, reconcile
+from misc import routing, broadcast, subscription, idempotency, user_cache, read_model
 from app.redis_client import init_redis
+from app import updates
+from yooka.payments import find_payment
 from redis.asyncio import Redis
 import app.redis_client as redis_module 
 from app.redis_client import close_redis
 
 
 from litestar import Litestar, post, get, Request
-from litestar.response import Redirect,Template
-from litestar.exceptions import NotFoundException, ServiceUnavailableException
+from litestar.response import Redirect,Template, Response
+from litestar.exceptions import HTTPException, NotFoundException, ServiceUnavailableException
 from litestar.contrib.jinja import JinjaTemplateEngine
 from litestar.template.config import TemplateConfig
 from litestar.static_files import StaticFilesConfig
 
 from pathlib import Path
-import json
-import aiohttp, asyncio
+import orjson
+import asyncio
+from sqlalchemy import update
 from contextlib import asynccontextmanager
 
 
@@ -37,39 +44,81 @@ import handlers.admin
 
 BASE_DIR = Path(__file__).parent
 
-# Lifespan для управления webhook
+WEBHOOK_LOCK = "bot:webhook:lock"
+
+
+# Lifespan: ресурсы воркера и webhook
 @asynccontextmanager
 async def lifespan(app: Litestar):
-    """Lifecycle events для установки/удаления webhook"""
-    await bot.delete_webhook()
-    logger.debug("Вебхук удалён")
-    await bot.set_webhook(
-        url=settings.WEBHOOK_URL,
-        drop_pending_updates=False
-    )
-    logger.info(f"Webhook установлен: {settings.WEBHOOK_URL}")
+    """
+    Ресурсы воркера (Redis, пул БД, пулы к панелям) создаются здесь,
+    в каждом процессе Granian свои: модульные redis_client, engine
+    и сессии панелей у каждого процесса собственные.
+    """
+    redis_module.redis_client = await init_redis()
+    await redis_module.redis_client.ping() #type: ignore
+    logger.info("Redis connected")
+
+    await setup_webhook(redis_module.redis_client)
     # async with engine.begin() as conn:
     #     await conn.run_sync(Base.metadata.drop_all)
     #     await conn.run_sync(Base.metadata.create_all)
 
-    global redis_client
+    await init_sessions(settings.M_DIGITAL_URL, settings.DNS1_URL, settings.DNS2_URL)
+    logger.info("Пулы соединений к панелям открыты")
 
-    redis_module.redis_client = await init_redis()
-    await redis_module.redis_client.ping() #type: ignore
-    logger.info("Redis connected")
+    await routing.load()
+
+    updates.start()
+
+    tasks = [
+        asyncio.create_task(panel_health.run_monitor()),
+        asyncio.create_task(broadcast.listen()),
+        asyncio.create_task(routing.run_resync()),
+        asyncio.create_task(outbox.run_worker()),
+        asyncio.create_task(stream.run_consumer()),
+        asyncio.create_task(read_model.run_sweep()),
+        asyncio.create_task(reconcile.run_scheduled()),
+    ]
 
 
     yield
 
 
+    # Сначала дорабатываем принятые апдейты, пока живы Redis и пулы
+    await updates.stop()
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    await close_sessions()
+    logger.info("Пулы соединений к панелям закрыты")
+
     await close_redis()
     logger.info("Redis disconnected")
 
+    await dispose_engine()
+    logger.info("Пул БД закрыт")
+
+    # Вебхук не удаляем: остановка одного воркера не должна
+    # отключать доставку апдейтов остальным
     await bot.session.close()
-    await bot.delete_webhook()
     logger.info("Бот остановлен")
 
 
+async def setup_webhook(redis: Redis) -> None:
+    """Ставит вебхук один раз на запуск: делает воркер, взявший лок"""
+    if not await redis.set(WEBHOOK_LOCK, settings.WEBHOOK_URL, nx=True, ex=settings.WEBHOOK_LOCK_TTL):
+        logger.debug("Вебхук ставит другой воркер")
+        return
+    await bot.set_webhook(
+        url=settings.WEBHOOK_URL,
+        drop_pending_updates=False
+    )
+    logger.info(f"Webhook установлен: {settings.WEBHOOK_URL}")
+
+
 # Health check
 @get("/")
 async def root() -> dict:
@@ -105,180 +154,215 @@ async def vpn_guide(user_id: str) -> Template:
 
 
 # Telegram webhook
-@post("/webhook")
+@post("/webhook", status_code=200)
 async def webhook(request: Request) -> dict:
-    logger.debug(f"Запрос от TelegramAPI пришёл.")
-    data = await request.json()
-
-    logger.debug(f"Udate TelegramApi {data}")
-    update = types.Update(**data)
+    # Валидация сразу из байт тела, без промежуточного dict
+    update = types.Update.model_validate_json(await request.body(), context={"bot": bot})
+    logger.debug(f"Апдейт TelegramApi {update.update_id}")
 
-    await dp.feed_update(bot, update)
-    return {"ok": True}
+    if not (await idempotency.claim("update", update.update_id)).first:
+        logger.info(f"Повтор апдейта {update.update_id}")
+        return {"ok": True}
 
-
-async def accept_panel(new_link: dict, username: str):
-    logger.debug("Зашли в редактор БД")
+    # Обработка - в воркерах app.updates. Если хендлер быстро вернул
+    # метод Bot API, отдаём его в теле ответа вместо отдельного запроса
     try:
-        async with async_session() as session:
-            repo = BaseRepository(session=session, model=LinksOrm)
-            logger.debug(f'{"="*15} Репо создан {"="*15}')
-            base_res = await repo.update_where(
-                    data=new_link, 
-                    user_id=username)
-            logger.debug(f'Новая запись {base_res}')
-    except Exception as e:
-        logger.error(f'Ошибка при добавленни ссылки в БД {e}')
-        raise ValueError
+        reply = updates.submit(update)
+    except updates.Overloaded as e:
+        # Не 200 - Telegram повторит доставку позже
+        logger.warning(f"Апдейт {update.update_id} отклонён: {e}")
+        await idempotency.release("update", update.update_id)
+        raise ServiceUnavailableException(detail="Overloaded")
+
+    method = await updates.wait_reply(reply, timeout=settings.UPDATES_REPLY_WAIT)
+    if method is not None:
+        return method
+    return {"ok": True}
 
 
 # Marzban webhook
 @post("/marzban")
 async def webhook_marz(request: Request) -> dict:
-    data = await request.json()
-    logger.debug(data)
-    data_str = json.dumps(data, ensure_ascii=False)
-
-    username = data[0]['username']
-    action   = data[0]['action']
-    cache_key = f"marzban:{username}:{action}"
-
-    if action == "reached_days_left":
-        ttl = 3600  
-    elif action == "user_expired":
-        ttl = 300   
-    else:
-        ttl = 60    
-
-    logger.debug(f'Пришли данные до Редиса {username} | {action} | {cache_key}')
-    exist = await redis_module.redis_client.exists(cache_key) #type: ignore
-    logger.debug(exist)
+    data = orjson.loads(await request.body())
 
-    if exist: #type: ignore
-        logger.info(f'Дублирование операции для {username}')
-        return {'msg': 'operation for user been'}
+    # Marzban шлёт массив событий, обрабатываем все
+    events = data if isinstance(data, list) else [data]
 
-    logger.debug(action)
-    await redis_module.redis_client.set(cache_key, "1", ex=ttl) #type: ignore
-    logger.debug('Добавлен в Redis')
+    # Только пишем в стрим, обработка - в stream.run_consumer
+    try:
+        ids = await stream.append(events)
+    except Exception as e:
+        logger.error(f'Стрим Marzban недоступен, обрабатываем сразу: {e}')
+        stats = await process_batch(events)
+        return {"ok": True, **stats}
 
+    logger.debug(f'Пришёл запрос от Marzban, в стриме {len(ids)} событий')
+    return {"ok": True, "received": len(events), "queued": len(ids)}
 
-    logger.debug(f'Пришёл запрос от Marzban {data_str[:20]}')
-    if action == 'user_created':
-        await create_user_sync(data=data)
 
-    elif action == 'user_updated':
-        await update_user_sync(data=data)
-
-    elif action == 'user_expired':
-        print('Отправить сообщение юзеру')
-        
-    elif action == 'reached_days_left':
-        print('Отправить сообщение юзеру День остался')
-
-    return {"ok": True}
 
+# Subscription redirect
+async def wait_disconnect(request: Request) -> None:
+    """Завершается, когда клиент закрыл соединение"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
 
 
-# Subscription redirect
 @get("/sub/{uuid:str}")
-async def process_sub(uuid: str) -> Redirect:
-    """Проверяем все панели параллельно"""
+async def process_sub(uuid: str, request: Request) -> Response:
+    """
+    Отдаём первую живую панель по данным фонового монитора.
+    Если монитор живых не знает - хеджированно проверяем ссылки сами.
+    С SUB_MERGE клиентам со списком ссылок отдаём объединённую
+    подписку всех панелей из кэша.
+    """
     
     links = await get_links_of_panels(uuid=uuid)
     logger.debug(f'Ссылки {links}')
     
     if not links:
         raise NotFoundException(detail="Subscription not found")
-    
-    async def check_panel(link: str, max_attempts: int = 15, delay: int = 1) -> tuple[bool, str]:
-        """Проверить доступность панели с retry"""
-        timeout = aiohttp.ClientTimeout(total=3.0)
-        connector = aiohttp.TCPConnector(ssl=False)
-        
-        for attempt in range(max_attempts):
-            try:
-                async with aiohttp.ClientSession(
-                    timeout=timeout,
-                    connector=connector
-                ) as session:
-                    response = await session.get(url=link)
-                    
-                    # Успех
-                    if response.status in (200, 201):
-                        return (True, link)
-                    
-                    # Серверные ошибки - retry
-                    elif 500 <= response.status < 600 and attempt < max_attempts - 1:
-                        logger.warning(f"Panel {link} retry {attempt + 1}/{max_attempts}: статус {response.status}")
-                        if attempt % 5 == 0:
-                            await asyncio.sleep(delay * 20 * (attempt + 1))
-                        await asyncio.sleep(delay * (attempt + 1))
-                        continue
-                    
-                    # Клиентские ошибки - сразу False
-                    else:
-                        return (False, link)
-            
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                if attempt < max_attempts - 1:
-                    logger.warning(f"Panel {link} retry {attempt + 1}/{max_attempts}: {e}")
-                    if attempt % 5 == 0:
-                        await asyncio.sleep(delay * 20 * (attempt + 1))
-                    await asyncio.sleep(delay * (attempt + 1))
-                else:
-                    logger.debug(f"Panel {link} недоступна после {max_attempts} попыток")
-                    return (False, link)
-            
-            except Exception as e:
-                logger.error(f"Неожиданная ошибка при проверке {link}: {e}")
-                return (False, link)
-        
-        return (False, link)
-    
-    # Проверяем все панели параллельно
-    results = await asyncio.gather(*[check_panel(link) for link in links])
-    
-    # Выбираем первую рабочую
-    for is_available, link in results:
-        if is_available:
-            logger.debug(f"Подписка отдана: {link}")
-            return Redirect(path=link)
-    logger.warning("Панели недоступны")
-    # Все недоступны
-    raise ServiceUnavailableException(detail="All panels unavailable")
+
+    # Склеиваем только списки ссылок; Clash/sing-box и т.п. - редиректом
+    if settings.SUB_MERGE and subscription.mergeable(request.headers.get("user-agent")):
+        merged = await merged_sub(uuid=uuid, links=links, request=request)
+        if merged is not None:
+            return merged
+
+    link = panel_health.pick_link(links)
+    if link is None:
+        link = await panel_health.first_available(
+            links=panel_health.fallback_order(links),
+            deadline=settings.SUB_DEADLINE,
+            hedge_delay=settings.SUB_HEDGE_DELAY,
+            abort=wait_disconnect(request),
+        )
+
+    if link is None:
+        logger.warning("Панели недоступны")
+        raise ServiceUnavailableException(detail="All panels unavailable")
+
+    logger.debug(f"Подписка отдана: {link}")
+    return Redirect(path=link)
+
+
+async def merged_sub(uuid: str, links: dict, request: Request) -> Response | None:
+    """None - собрать не вышло, отдаём редиректом"""
+    sub = await subscription.get_merged(uuid=uuid, links=links, user_agent=request.headers.get("user-agent"))
+    if sub is None:
+        logger.warning(f"Подписку {uuid} не удалось собрать, отдаём редирект")
+        return None
+
+    headers = {
+        **sub.headers,
+        "ETag": sub.etag,
+        "Last-Modified": sub.last_modified,
+        "Cache-Control": "no-cache",
+    }
+    if subscription.not_modified(
+        sub,
+        if_none_match=request.headers.get("if-none-match"),
+        if_modified_since=request.headers.get("if-modified-since"),
+    ):
+        return Response(content=b"", status_code=304, headers=headers)
+
+    return Response(content=sub.body, media_type="text/plain", headers=headers)
 
 
 
 @post("/pay")
 async def yoo_kassa(request: Request) -> dict:
-    data = await request.json()
-    event = data.get('event')
+    data = orjson.loads(await request.body())
     order_id = data.get('object', {}).get("id", {})
     
-    if order_id == {}:
+    if not isinstance(order_id, str) or not order_id:
         logger.warning(f'{order_id} Response: {data}')
         return {"status": "ne-ok"}
-    
+
+    # Тело уведомления может прислать кто угодно: платёж перечитываем
+    # из API YooKassa, событие и сумма - только оттуда
+    payment = await find_payment(order_id)
+    if payment is None:
+        logger.warning(f'Платёж {order_id} не найден в YooKassa, уведомление: {data}')
+        return {"status": "ne-ok"}
+    event = f"payment.{payment['status']}"
+
+    # YooKassa повторяет уведомления, пока не получит 200: повтору отдаём
+    # ответ первой доставки, а пока она идёт - 409, чтобы повтор пришёл ещё
+    key = f"{order_id}:{event}"
+    claim = await idempotency.claim("pay", key)
+    if not claim.first:
+        logger.info(f"Повтор уведомления {key}")
+        if claim.result is None:
+            raise HTTPException(status_code=409, detail="Payment is being processed")
+        return claim.result
+
+    try:
+        result = await handle_payment(payment=payment, order_id=order_id, event=event)
+    except Exception:
+        await idempotency.release("pay", key)
+        raise
+    await idempotency.remember("pay", key, result)
+    return result
+
+
+async def handle_payment(payment: dict, order_id: str, event: str) -> dict:
     obj = await change_status(order_id=order_id, status=event)
     if not obj:
         logger.info(f"Order: {order_id} was canceled or TimeOut")
         return {"response": "Order was canceled"}
     
-    backend = MarzbanClient(settings.M_DIGITAL_URL)
-    
-    obj_data = data.get("object", {})
-    pay_id, pay_am = obj_data.get('id'), obj_data.get('amount')
-    logger.info(f'{pay_id} | {pay_am}')
-    
-    user_marz = await backend.get_user(user_id=obj.user_id)
-    expire = calculate_expire(old_expire=user_marz['expire']) #type: ignore
-    new_expire = new_date(expire=expire, amount=pay_am['value'])
+    pay_id, pay_am = payment.get('id'), payment.get('amount') or {}
+    logger.info(f'{pay_id} | {pay_am} | заказ на {obj.amount}')
+
+    # Тариф - по сумме заказа из БД; оплачено должно быть столько же
+    if int(float(pay_am.get('value', 0))) != obj.amount:
+        logger.error(f"Оплата {order_id}: оплачено {pay_am}, а заказ на {obj.amount} - не применяем")
+        await reset_applied(order_id)
+        return {"response": "Amount mismatch"}
     
     try:
-        await modify_user(username=obj.user_id) #, expire=new_expire)
-        logger.info(f"Для пользователя {obj.user_id} оплата и обработка прошли успешно.")
-        
+        # expire из локальной модели, к панели - только если пользователя там нет
+        state = await read_model.get(obj.user_id)
+        if state is None:
+            user_marz = await MarzbanClient(settings.M_DIGITAL_URL).get_user(user_id=obj.user_id)
+            old_expire = user_marz['expire'] if user_marz else None
+        else:
+            old_expire = state.expire
+        expire = calculate_expire(old_expire=old_expire)
+        new_expire = new_date(expire=expire, amount=str(obj.amount))
+
+        await modify_user(username=obj.user_id)
+        res = await MarzbanClient(settings.M_DIGITAL_URL).modify_user(
+            user_id=obj.user_id,
+            expire=int(new_expire.timestamp()),
+        )
+        if res is None:
+            raise ValueError(f"Панель не продлила {obj.user_id} до {new_expire}")
+
+        # Новый срок сразу в локальную модель, не дожидаясь вебхука панели
+        sub = read_model.project(res)
+        if sub is not None:
+            await read_model.save({obj.user_id: sub})
+        await user_cache.invalidate(obj.user_id)
+    except Exception as e:
+        # Не 200: ключ и applied освобождаются, YooKassa пришлёт уведомление снова
+        logger.error(f"Оплата {order_id} пользователя {obj.user_id} не применена: {e}")
+        await reset_applied(order_id)
+        try:
+            await bot.send_message(
+                text="Возникла ошибка, напиши в поддержку /help",
+                chat_id=obj.user_id
+            )
+        except Exception as e:
+            logger.warning(e)
+        raise
+    logger.info(f"Для пользователя {obj.user_id} оплата и обработка прошли успешно.")
+
+    # Продление уже записано - ошибка уведомления повтора не вызывает
+    try:
         await bot.send_message(
             chat_id=obj.user_id, #type: ignore
             text=f"Оплата прошла успешно на сумму: {obj.amount}", #type: ignore
@@ -291,10 +375,6 @@ async def yoo_kassa(request: Request) -> dict:
         )
     except Exception as e:
         logger.warning(e)
-        await bot.send_message(
-            text="Возникла ошибка, напиши в поддержку /help",
-            chat_id=obj.user_id
-        )
     
     return {"ok": True}
 
@@ -311,6 +391,8 @@ async def change_status(order_id: str, status: str) -> PaymentData | None:
     1. Canceled - Возвращает -- None -- и удаляет запись из бд с order_id
     2. waiting_for_capture - Неизвестный ответ возвращает -- None --
     3. Succeeded - меняет статус у записи с order_id и возвращает объект -- ORM --
+       Вместе со статусом в той же транзакции ставится applied: уже применённый
+       платёж второй раз не вернётся (-- None --), даже когда ключ в Redis истёк
     '''
 
     st = status.split(".")[1]
@@ -319,9 +401,19 @@ async def change_status(order_id: str, status: str) -> PaymentData | None:
     async with async_session() as session:
         repo = BaseRepository(session=session, model=PaymentData)
         if st == 'succeeded':
-            res = await repo.update_one({
-                "status": st
-            }, payment_id=order_id)
+            stmt = (
+                update(PaymentData)
+                .where(PaymentData.payment_id == order_id, PaymentData.applied.is_not(True))
+                .values(status=st, applied=True)
+                .returning(PaymentData)
+                .execution_options(synchronize_session=False)
+            )
+            res = (await session.execute(stmt)).scalar_one_or_none()
+            await session.commit()
+            if res is None:
+                logger.info(f'Платёж {order_id} уже применён или не найден')
+                return None
+            await session.refresh(res)
             logger.debug(f'Ответ из БД после обновления {res}')
             return res
         elif st == 'canceled':
@@ -331,6 +423,18 @@ async def change_status(order_id: str, status: str) -> PaymentData | None:
         
 
 
+async def reset_applied(order_id: str) -> None:
+    '''
+    Снять applied, если продление не записалось: повтор уведомления
+    применит платёж заново. Ошибка здесь только логируется.
+    '''
+    try:
+        async with async_session() as session:
+            await BaseRepository(session=session, model=PaymentData).update_where({"applied": False}, payment_id=order_id)
+    except Exception as e:
+        logger.error(f'Не удалось снять applied у платежа {order_id}: {e}')
+
+
 # Создание приложения
 app = Litestar(
     route_handlers=[
@@ -339,6 +443,7 @@ app = Litestar(
         webhook,
         webhook_marz,
         process_sub,
+        yoo_kassa,
         vpn_guide
     ],
     lifespan=[lifespan],
@@ -0,0 +1,197 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any
+
+from aiogram import types
+from aiogram.methods import TelegramMethod
+from redis.exceptions import LockError
+
+import app.redis_client as redis_module
+from bot_instance import bot, dp
+from config_data.config import settings
+from logger_setup import logger
+
+
+class Overloaded(Exception):
+    """Очередь апдейтов заполнена - апдейт не принят"""
+
+
+# Одна очередь на воркер: апдейты одного чата всегда попадают в одну
+# очередь и обрабатываются по порядку, разные чаты - параллельно.
+# Между процессами (--prod) очереди не общие: там чат держит блокировку
+# в Redis на время хендлера (_chat_lock)
+_queues: list[asyncio.Queue] = []
+_workers: list[asyncio.Task] = []
+_accepting = False
+
+
+def chat_key(update: types.Update) -> int:
+    """id чата (или пользователя) апдейта для выбора очереди"""
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+
+def as_reply(method: TelegramMethod) -> dict[str, Any] | None:
+    '''
+    Тело ответа на вебхук с вызовом метода Bot API.
+    None - метод нельзя отдать в ответе (загрузка файлов).
+    '''
+    files: dict[str, Any] = {}
+    payload: dict[str, Any] = {"method": method.__api_method__}
+    for key, value in method.model_dump(warnings=False).items():
+        value = bot.session.prepare_value(value, bot=bot, files=files, _dumps_json=False)
+        if value is not None:
+            payload[key] = value
+    if files:
+        return None
+    return payload
+
+
+async def _reply(result: Any, reply: asyncio.Future) -> None:
+    '''
+    Хендлер вернул метод Bot API (return message.answer(...)).
+    Пока вебхук ждёт - отдаём метод ему, иначе вызываем сами.
+    '''
+    if not isinstance(result, TelegramMethod):
+        if not reply.done():
+            reply.set_result(None)
+        return
+
+    payload = as_reply(result)
+    if payload is not None and not reply.done():
+        reply.set_result(payload)
+        return
+
+    if not reply.done():
+        reply.set_result(None)
+    await bot(result)
+
+
+@asynccontextmanager
+async def _chat_lock(update: types.Update):
+    '''
+    Апдейты одного чата из разных процессов - по одному (FSM, двойные нажатия).
+    Не дождались блокировки или нет Redis - обрабатываем без неё.
+    '''
+    redis = redis_module.redis_client
+    lock = None
+    if redis is not None:
+        lock = redis.lock(
+            f"updates:chat:{chat_key(update)}",
+            timeout=settings.UPDATES_CHAT_LOCK_TTL,
+            sleep=0.01,
+            blocking_timeout=settings.UPDATES_CHAT_LOCK_WAIT,
+        )
+        try:
+            if not await lock.acquire():
+                logger.warning(f"Чат апдейта {update.update_id} занят дольше {settings.UPDATES_CHAT_LOCK_WAIT} сек")
+                lock = None
+        except Exception as e:
+            logger.warning(f"Не удалось взять блокировку чата: {e}")
+            lock = None
+    try:
+        yield
+    finally:
+        if lock is not None:
+            try:
+                await lock.release()
+            except LockError:
+                # Хендлер шёл дольше UPDATES_CHAT_LOCK_TTL - блокировка уже истекла
+                pass
+            except Exception as e:
+                logger.warning(f"Не удалось снять блокировку чата: {e}")
+
+
+async def _worker(queue: asyncio.Queue) -> None:
+    while True:
+        update, reply = await queue.get()
+        try:
+            async with _chat_lock(update):
+                result = await dp.feed_update(bot, update)
+                await _reply(result, reply)
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            if not reply.done():
+                reply.set_result(None)
+        finally:
+            queue.task_done()
+
+
+def start() -> None:
+    """Запустить воркеры (lifespan)"""
+    global _accepting
+    size = max(settings.UPDATES_QUEUE_SIZE // settings.UPDATES_WORKERS, 1)
+    for _ in range(settings.UPDATES_WORKERS):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+        _queues.append(queue)
+        _workers.append(asyncio.create_task(_worker(queue)))
+    _accepting = True
+    logger.info(f"Воркеры апдейтов запущены: {settings.UPDATES_WORKERS}, очередь {settings.UPDATES_QUEUE_SIZE}")
+
+
+def submit(update: types.Update) -> asyncio.Future:
+    '''
+    Ставит апдейт в очередь его чата без ожидания.
+    Возвращает future с телом ответа на вебхук (или None).
+    Overloaded - очередь полна или идёт остановка.
+    '''
+    if not _accepting:
+        raise Overloaded("shutting down")
+    queue = _queues[chat_key(update) % len(_queues)]
+    reply = asyncio.get_running_loop().create_future()
+    try:
+        queue.put_nowait((update, reply))
+    except asyncio.QueueFull:
+        raise Overloaded(f"queue full ({queue.maxsize})")
+    return reply
+
+
+async def wait_reply(reply: asyncio.Future, timeout: float) -> dict[str, Any] | None:
+    '''
+    Ждёт ответ хендлера не дольше timeout.
+    Не дождались - future отменяется, и воркер сам отправит метод в Bot API.
+    '''
+    try:
+        return await asyncio.wait_for(asyncio.shield(reply), timeout=timeout)
+    except asyncio.CancelledError:
+        reply.cancel()
+        raise
+    except asyncio.TimeoutError:
+        # cancel() не сработает, если воркер успел ответить в этот же момент
+        if reply.cancel():
+            return None
+        return reply.result()
+
+
+def depth() -> int:
+    return sum(queue.qsize() for queue in _queues)
+
+
+async def stop() -> None:
+    '''
+    Перестаёт принимать апдейты, дожидается обработки очереди
+    (не дольше UPDATES_DRAIN_TIMEOUT) и останавливает воркеры.
+    '''
+    global _accepting
+    _accepting = False
+    left = depth()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*[queue.join() for queue in _queues]),
+            timeout=settings.UPDATES_DRAIN_TIMEOUT,
+        )
+        logger.info(f"Очередь апдейтов обработана ({left} шт.)")
+    except asyncio.TimeoutError:
+        logger.warning(f"Не успели обработать {depth()} апдейтов за {settings.UPDATES_DRAIN_TIMEOUT} сек")
+
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queues.clear()
@@ -1,8 +1,18 @@
+from pydantic import BaseModel, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pathlib import Path
+from typing import Literal
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+
+class PanelConfig(BaseModel):
+    name: str                 # ключ панели в user_panel_links
+    url: str                  # адрес API панели
+    match: str | None = None  # подстрока subscription_url этой панели
+    weight: float = 1.0       # доля трафика /sub относительно других панелей
+
+
 class Settings(BaseSettings):
     # Bot
     BOT_TOKEN: str
@@ -16,6 +26,109 @@ class Settings(BaseSettings):
     DNS1_URL: str
     DNS2_URL: str
 
+    # Реестр панелей, JSON-список PanelConfig.
+    # Пустой - две панели panel_1/panel_2 из DNS1_URL/DNS2_URL
+    PANELS: list[PanelConfig] = []
+
+    # Продакшн запуск Granian: python run.py --prod
+    WEB_HOST: str = "127.0.0.1"
+    WEB_PORT: int = 8000
+    WEB_WORKERS: int = 0  # 0 - по числу ядер
+    WEB_LOOP: Literal["auto", "asyncio", "uvloop", "rloop"] = "uvloop"
+    WEB_BACKLOG: int = 2048
+    WEB_RUNTIME_THREADS: int = 1
+    WEB_BLOCKING_THREADS: int | None = None
+
+    # set_webhook делает только воркер, взявший лок
+    WEBHOOK_LOCK_TTL: int = 60
+
+    # Пул соединений к БД на один воркер
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 10
+
+    # Пулы соединений к панелям
+    MARZ_POOL_LIMIT: int = 100
+    MARZ_POOL_LIMIT_PER_HOST: int = 20
+    MARZ_KEEPALIVE_TIMEOUT: float = 60
+    MARZ_DNS_TTL: int = 300
+
+    # Размер страницы MarzbanClient.iter_users
+    MARZ_USERS_PAGE: int = 500
+
+    # Репликация событий Marzban: одновременных запросов на одну панель
+    REPLICATION_PER_PANEL: int = 8
+    # Сколько пользователей из одной пачки вебхука обрабатывать одновременно
+    EVENTS_CONCURRENCY: int = 16
+    # Склейка серий user_updated: ждём N сек тишины, но не дольше MAX_WAIT
+    EVENTS_COALESCE_WINDOW: float = 2
+    EVENTS_COALESCE_MAX_WAIT: float = 10
+
+    # Лог событий Marzban в Redis Stream и группа консумеров
+    MARZ_STREAM: str = "marzban:events"
+    MARZ_STREAM_GROUP: str = "marzban"
+    MARZ_STREAM_MAXLEN: int = 100_000
+    MARZ_STREAM_BATCH: int = 100
+    MARZ_STREAM_BLOCK_MS: int = 2000
+    MARZ_STREAM_CLAIM_IDLE_MS: int = 60_000
+
+    # Обработка апдейтов Telegram в фоне
+    UPDATES_WORKERS: int = 16
+    UPDATES_QUEUE_SIZE: int = 1000
+    UPDATES_DRAIN_TIMEOUT: float = 20
+    # Сколько /webhook ждёт ответ хендлера, чтобы вернуть его в теле ответа
+    UPDATES_REPLY_WAIT: float = 0.3
+    # Блокировка чата в Redis: при нескольких процессах (--prod) апдейты
+    # одного чата не обрабатываются одновременно
+    UPDATES_CHAT_LOCK_TTL: float = 30
+    UPDATES_CHAT_LOCK_WAIT: float = 5
+
+    # Кэш пользователей Marzban: Redis + память процесса
+    USER_CACHE_TTL: int = 300            # свежая запись
+    USER_CACHE_STALE_TTL: int = 86400    # сколько хранится последнее хорошее значение
+    USER_CACHE_REFRESH_WAIT: float = 2   # ожидание панели при промахе
+    USER_CACHE_FETCH_ATTEMPTS: int = 2
+    USER_CACHE_LOCAL_TTL: float = 60
+    USER_CACHE_LOCAL_SIZE: int = 10_000
+
+    # Сверка локальной модели подписок с основной панелью
+    READ_MODEL_SWEEP_INTERVAL: float = 3600
+
+    # Сверка пользователей между панелями (python -m marz.reconcile)
+    RECONCILE_INTERVAL: float = 21600  # 0 - только вручную
+    RECONCILE_MAX_REPAIRS: int = 5000
+
+    # Массовые операции админа (marz.bulk): на каждую панель
+    BULK_PER_PANEL: int = 8  # запросов одновременно
+    BULK_RATE: float = 20  # запросов в секунду, 0 - без ограничения
+    BULK_JOB_TTL: int = 7 * 86400  # сколько хранить прогресс для продолжения
+
+    # Outbox записей в панели (add_to_panel_queue)
+    OUTBOX_BATCH: int = 50
+    OUTBOX_POLL_INTERVAL: float = 1
+    OUTBOX_BACKOFF_BASE: float = 5
+    OUTBOX_BACKOFF_MAX: float = 3600
+    OUTBOX_CALL_TIMEOUT: float = 60  # одна попытка задания, включая логин в панель
+    OUTBOX_LEASE: float = 180        # аренда задания (leased_until), больше OUTBOX_CALL_TIMEOUT
+
+    # Фоновый мониторинг панелей
+    HEALTH_INTERVAL: float = 5
+    HEALTH_TIMEOUT: float = 3
+    HEALTH_STALE_AFTER: float = 30
+    HEALTH_EWMA_ALPHA: float = 0.3
+    HEALTH_ERROR_PENALTY: float = 10  # во сколько раз 100% ошибок хуже задержки
+
+    # /sub: живая проверка, если монитор не знает живых панелей
+    SUB_DEADLINE: float = 5
+    SUB_HEDGE_DELAY: float = 0.3
+
+    # Таблица маршрутов uuid -> панели: полная перезагрузка раз в N сек
+    LINKS_RESYNC_INTERVAL: float = 600
+    LINKS_BLOOM_ERROR_RATE: float = 0.001
+
+    # /sub отдаёт объединённую подписку всех панелей вместо редиректа
+    SUB_MERGE: bool = False
+    SUB_CACHE_TTL: int = 60
+    SUB_FETCH_TIMEOUT: float = 5
 
     #Anymessage
     ANY_TOKEN: str
@@ -42,6 +155,15 @@ class Settings(BaseSettings):
     REDIS_PORT: int
     REDIS_PASS: str
 
+    @model_validator(mode="after")
+    def default_panels(self):
+        if not self.PANELS:
+            self.PANELS = [
+                PanelConfig(name="panel_1", url=self.DNS1_URL, match="dns1"),
+                PanelConfig(name="panel_2", url=self.DNS2_URL, match="dns2"),
+            ]
+        return self
+
     @property
     def DATABASE_URL(self) -> str:
         """Асинхронный URL для asyncpg"""
@@ -3,10 +3,21 @@ from config_data.config import settings
 from db.db_models import *
 
 
+# Движок создаётся при импорте, но соединения открываются лениво -
+# у каждого воркера Granian свой пул
 engine = create_async_engine(
-    url=settings.DATABASE_URL
+    url=settings.DATABASE_URL,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
     )
 
 async_session = async_sessionmaker(
     bind=engine
 )
+
+
+
+async def dispose_engine() -> None:
+    """Закрыть пул соединений воркера (lifespan)"""
+    await engine.dispose()
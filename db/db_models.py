@@ -1,7 +1,7 @@
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from datetime import datetime
-from sqlalchemy import func, ForeignKey
-from sqlalchemy import ARRAY, String
+from sqlalchemy import func, text, ForeignKey, Index, UniqueConstraint
+from sqlalchemy import ARRAY, BigInteger, String
 
 
 class Base(DeclarativeBase):
@@ -38,16 +38,66 @@ class LinksOrm(Base):
     __tablename__ = 'links'
 
     user_id: Mapped[str] = mapped_column(primary_key=True)
-    uuid: Mapped[str]
+    uuid: Mapped[str] = mapped_column(index=True)
     panel_1: Mapped[str | None]
     panel_2: Mapped[str | None]
 
 
+class UserPanelLinkOrm(Base):
+    __tablename__ = 'user_panel_links'
+
+    user_id: Mapped[str] = mapped_column(ForeignKey('links.user_id'), primary_key=True)
+    panel: Mapped[str] = mapped_column(primary_key=True)
+    sub_url: Mapped[str]
+
+
 class PanelQueue(Base):
+    """
+    Outbox записей в панели: желаемое состояние пользователя на панели.
+    Одна строка на (username, panel) - новое событие перезаписывает старое.
+    После записи в панель строка остаётся (applied_version = version):
+    по ней отбрасываются более старые события из reclaim и replay.
+    """
     __tablename__ = 'add_to_panel_queue'
+    __table_args__ = (
+        UniqueConstraint("username", "panel"),
+        Index(
+            "ix_add_to_panel_queue_pending", "next_try_at",
+            postgresql_where=text("applied_version IS NULL OR version > applied_version"),
+        ),
+    )
 
-    uuid: Mapped[str] = mapped_column(primary_key=True)
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    uuid: Mapped[str]
     panel: Mapped[str]
     username: Mapped[str]
-    expire: Mapped[int]
+    expire: Mapped[int | None]
     inbounds: Mapped[list] = mapped_column(ARRAY(item_type=String))
+    action: Mapped[str] = mapped_column(server_default='user_created')
+    attempts: Mapped[int] = mapped_column(default=0, server_default='0')
+    next_try_at: Mapped[datetime] = mapped_column(server_default=func.now(), index=True)
+    # Аренда задания воркером outbox (enqueue её не трогает)
+    leased_until: Mapped[datetime | None]
+    last_error: Mapped[str | None]
+    created_at: Mapped[datetime] = mapped_column(server_default=func.now())
+    # Версия события (misc.versions): более старое состояние строку не перезапишет
+    version: Mapped[int] = mapped_column(BigInteger, default=0, server_default='0')
+    # Версия, уже записанная в панель; None - ещё ни одной
+    applied_version: Mapped[int | None] = mapped_column(BigInteger)
+
+
+class SubscriptionStateOrm(Base):
+    """
+    Локальная копия подписки пользователя на основной панели (M_DIGITAL_URL).
+    Обновляется из вебхуков Marzban и оплат, сверяется с панелью периодически.
+    """
+    __tablename__ = 'subscription_state'
+
+    user_id: Mapped[str] = mapped_column(primary_key=True)
+    status: Mapped[str | None]
+    expire: Mapped[int | None]
+    sub_link: Mapped[str | None]
+    links: Mapped[list] = mapped_column(ARRAY(item_type=String), server_default='{}')
+    titles: Mapped[list] = mapped_column(ARRAY(item_type=String), server_default='{}')
+    updated_at: Mapped[datetime] = mapped_column(server_default=func.now(), onupdate=func.now())
+    version: Mapped[int] = mapped_column(BigInteger, default=0, server_default='0')
@@ -0,0 +1,6 @@
+-- Индекс по links.uuid: поиск ссылок подписки в /sub (LinksOrm.uuid, index=True).
+-- create_all в lifespan отключён, схему меняем вручную, по порядку номеров:
+--   psql "$DATABASE_URL" -f db/migrations/001_links_uuid_index.sql
+-- Повторный запуск ничего не ломает.
+
+CREATE INDEX IF NOT EXISTS ix_links_uuid ON links (uuid);
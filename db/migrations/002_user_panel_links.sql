@@ -0,0 +1,11 @@
+-- Ссылки пользователя по панелям реестра (UserPanelLinkOrm).
+-- Колонки links.panel_1/panel_2 остаются и читаются как запасной вариант,
+-- поэтому переносить старые ссылки не нужно.
+--   psql "$DATABASE_URL" -f db/migrations/002_user_panel_links.sql
+
+CREATE TABLE IF NOT EXISTS user_panel_links (
+    user_id VARCHAR NOT NULL REFERENCES links (user_id),
+    panel   VARCHAR NOT NULL,
+    sub_url VARCHAR NOT NULL,
+    PRIMARY KEY (user_id, panel)
+);
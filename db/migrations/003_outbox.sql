@@ -0,0 +1,44 @@
+-- Outbox записей в панели (PanelQueue, marz/outbox.py).
+-- Старая add_to_panel_queue (первичный ключ uuid) в коде не использовалась:
+-- ключ меняется на id, добавляются поля очереди и уникальность (username, panel).
+--   psql "$DATABASE_URL" -f db/migrations/003_outbox.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS add_to_panel_queue (
+    uuid     VARCHAR   NOT NULL,
+    panel    VARCHAR   NOT NULL,
+    username VARCHAR   NOT NULL,
+    expire   INTEGER,
+    inbounds VARCHAR[] NOT NULL
+);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'add_to_panel_queue' AND column_name = 'id'
+    ) THEN
+        ALTER TABLE add_to_panel_queue DROP CONSTRAINT IF EXISTS add_to_panel_queue_pkey;
+        ALTER TABLE add_to_panel_queue ADD COLUMN id SERIAL PRIMARY KEY;
+    END IF;
+END $$;
+
+ALTER TABLE add_to_panel_queue ALTER COLUMN expire DROP NOT NULL;
+ALTER TABLE add_to_panel_queue ADD COLUMN IF NOT EXISTS action      VARCHAR   NOT NULL DEFAULT 'user_created';
+ALTER TABLE add_to_panel_queue ADD COLUMN IF NOT EXISTS attempts    INTEGER   NOT NULL DEFAULT 0;
+ALTER TABLE add_to_panel_queue ADD COLUMN IF NOT EXISTS next_try_at TIMESTAMP NOT NULL DEFAULT now();
+ALTER TABLE add_to_panel_queue ADD COLUMN IF NOT EXISTS last_error  VARCHAR;
+ALTER TABLE add_to_panel_queue ADD COLUMN IF NOT EXISTS created_at  TIMESTAMP NOT NULL DEFAULT now();
+
+-- Одна строка на (username, panel): из дублей остаётся последняя
+DELETE FROM add_to_panel_queue a
+    USING add_to_panel_queue b
+    WHERE a.username = b.username AND a.panel = b.panel AND a.id < b.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS add_to_panel_queue_username_panel_key
+    ON add_to_panel_queue (username, panel);
+CREATE INDEX IF NOT EXISTS ix_add_to_panel_queue_next_try_at
+    ON add_to_panel_queue (next_try_at);
+
+COMMIT;
@@ -0,0 +1,14 @@
+-- Локальная модель подписок (SubscriptionStateOrm, misc/read_model.py).
+-- create_all отключён, применить вручную до выкладки:
+--   psql "$DATABASE_URL" -f db/migrations/004_subscription_state.sql
+-- Таблица наполняется вебхуками Marzban и сверкой read_model.run_sweep.
+
+CREATE TABLE IF NOT EXISTS subscription_state (
+    user_id    VARCHAR   PRIMARY KEY,
+    status     VARCHAR,
+    expire     INTEGER,
+    sub_link   VARCHAR,
+    links      VARCHAR[] NOT NULL DEFAULT '{}',
+    titles     VARCHAR[] NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
@@ -0,0 +1,7 @@
+-- Версия состояния пользователя (misc/versions.py) в outbox и локальной модели:
+-- консумеры стрима идут параллельно, более старое событие не перезаписывает новое.
+-- После 003_outbox.sql и 004_subscription_state.sql:
+--   psql "$DATABASE_URL" -f db/migrations/005_versions.sql
+
+ALTER TABLE add_to_panel_queue ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE subscription_state ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,5 @@
+-- Аренда заданий outbox в своей колонке: enqueue сдвигает next_try_at
+-- (окно склейки) и больше не сокращает аренду идущей попытки.
+--   psql "$DATABASE_URL" -f db/migrations/006_outbox_lease.sql
+
+ALTER TABLE add_to_panel_queue ADD COLUMN IF NOT EXISTS leased_until TIMESTAMP;
@@ -0,0 +1,9 @@
+-- Строки outbox остаются после записи в панель с отметкой applied_version:
+-- более старые события (reclaim, replay стрима) по ним отбрасываются.
+-- В очереди только строки с version > applied_version - для них частичный индекс.
+--   psql "$DATABASE_URL" -f db/migrations/007_outbox_applied.sql
+
+ALTER TABLE add_to_panel_queue ADD COLUMN IF NOT EXISTS applied_version BIGINT;
+CREATE INDEX IF NOT EXISTS ix_add_to_panel_queue_pending
+    ON add_to_panel_queue (next_try_at)
+    WHERE applied_version IS NULL OR version > applied_version;
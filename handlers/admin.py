@@ -1,10 +1,11 @@
 from aiogram import F, types
-from aiogram.filters import Command
-from bot_instance import dp
+from aiogram.filters import Command, CommandObject
+from bot_instance import bot, dp
 from keyboards.markup import Admin
 from aiogram.types import CallbackQuery
 from logger_setup import logger
 from misc.utils import get_user, create_user
+from marz import bulk
 from marz.backend import MarzbanClient
 from config_data.config import settings as s
 
@@ -69,17 +70,69 @@ async def health_check(callback: CallbackQuery):
 @dp.callback_query(F.data == 'users_cnt')
 async def users_cnt(callback: CallbackQuery):
     client = MarzbanClient(url=s.M_DIGITAL_URL)
-    users = await client.get_users()
-    if users is None:
-        users = dict()
-        users['total'] = 'Ошибка'
+    total = await client.count_users()
+    if total is None:
+        total = 'Ошибка'
 
     ANS_TEXT = f"""
-Количество пользователей: {users['total']}
+Количество пользователей: {total}
 """
     
 
     await callback.message.edit_text( #type: ignore
         text=ANS_TEXT,
         reply_markup=Admin.back()
-    )
\ No newline at end of file
+    )
+
+async def _bulk_report(report: bulk.JobReport):
+    await bot.send_message(chat_id=482410857, text=report.summary())
+
+
+@dp.message(Command("bulk_extend", "bulk_inbound"))
+async def cmd_bulk(message: types.Message, command: CommandObject):
+    '''
+    /bulk_extend <дней> [статус] - продлить всем на N дней
+    /bulk_inbound <inbound> [статус] - добавить всем inbound
+    статус - фильтр по статусу Marzban (active, expired, ...), по умолчанию all
+    '''
+    user_id = message.from_user.id #type: ignore
+    if user_id != 482410857:
+        logger.info(f'User {user_id} попытался запросить админ команду')
+        return
+
+    args = (command.args or "").split()
+    op = "extend" if command.command == "bulk_extend" else "inbound"
+    if not args or (op == "extend" and not args[0].lstrip("-").isdigit()):
+        return await message.answer(f"Использование: /{command.command} <{'дней' if op == 'extend' else 'inbound'}> [статус]")
+
+    spec = bulk.JobSpec(op=op, arg=args[0], status=args[1] if len(args) > 1 else "all")
+    bulk.start(spec, on_done=_bulk_report)
+    logger.info(f"Админ запустил bulk {spec.job_id}: {op} {spec.arg} ({spec.status})")
+    await message.answer(
+        f"Задача {spec.job_id} запущена: {op} {spec.arg} ({spec.status})\n"
+        f"Прогресс: /bulk_status {spec.job_id}\nПродолжить после сбоя: /bulk_resume {spec.job_id}"
+    )
+
+
+@dp.message(Command("bulk_resume", "bulk_status"))
+async def cmd_bulk_job(message: types.Message, command: CommandObject):
+    user_id = message.from_user.id #type: ignore
+    if user_id != 482410857:
+        logger.info(f'User {user_id} попытался запросить админ команду')
+        return
+
+    job_id = (command.args or "").strip()
+    if not job_id:
+        return await message.answer(f"Использование: /{command.command} <id задачи>")
+
+    if command.command == "bulk_status":
+        text = await bulk.status(job_id)
+        return await message.answer(text or f"Задача {job_id} не найдена")
+
+    if bulk.is_running(job_id):
+        return await message.answer(f"Задача {job_id} ещё выполняется")
+    spec = await bulk.load_spec(job_id)
+    if spec is None:
+        return await message.answer(f"Задача {job_id} не найдена")
+    bulk.start(spec, resumed=True, on_done=_bulk_report)
+    await message.answer(f"Задача {job_id} продолжена")
@@ -14,11 +14,10 @@ async def instriction_menu(callback: CallbackQuery):
 
     user = await get_user_in_links(user_id=user_id)
     if not user:
-        await callback.answer("Нужно преобрести подписку или активировать пробный период")
-        return
+        return callback.answer("Нужно преобрести подписку или активировать пробный период")
 
     uuid = user.uuid
-    await callback.message.edit_text( #type:ignore
+    return callback.message.edit_text( #type:ignore
         "🪞 Нажмите на кнопку ниже для просмотра инструкции:",
         reply_markup=Instruction.web_app_keyboard(uuid=uuid)
     )
\ No newline at end of file
@@ -44,12 +44,12 @@ async def call_start(callback: CallbackQuery):
     user = await get_user(user_id)
     
     if user is None:
-        await callback.message.edit_text( #type: ignore
+        return callback.message.edit_text( #type: ignore
             text=ERROR_TEXT,
             parse_mode="HTML"
         )# type: ignore
     else:    
-        await callback.message.edit_text( #type: ignore
+        return callback.message.edit_text( #type: ignore
             WELCOME_TEXT,
             reply_markup=MainKeyboard.main_keyboard(),
             parse_mode="HTML"
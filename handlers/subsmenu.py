@@ -4,9 +4,9 @@ from keyboards.builder import SubMenu
 from keyboards.deps import BackButton
 from aiogram.types import CallbackQuery
 from logger_setup import logger
-from misc.utils import to_link, get_sub_url, get_user_in_links, get_user_cached
+from misc.utils import get_sub_url, get_user_in_links, get_user_cached
 from config_data.config import settings as s
-import app.redis_client as redis_module
+from misc import idempotency
 
 
 
@@ -25,11 +25,10 @@ async def main_subs(callback: CallbackQuery):
 
     res = await get_sub_url(user_id)
     if res is None:
-        await callback.message.edit_text( #type: ignore
+        return callback.message.edit_text( #type: ignore
             text="❌ У вас пока нет активной подписки.\n\nОформите подписку для получения доступа к VPN.",
             reply_markup=BackButton.back_start()
         )
-        return
     
     logger.debug(f"ID : {user_id} | Получил Subs url {res}")
 
@@ -39,41 +38,24 @@ async def main_subs(callback: CallbackQuery):
 
     logger.debug(f"ID : {user_id} | Получил Паттерн и uuid {sub_link}")
 
-    res = await get_user_cached(user_id=user_id)
+    data = await get_user_cached(user_id=user_id)
 
-    if res is None:
-        await callback.message.edit_text( #type: ignore
+    if data is None:
+        return callback.message.edit_text( #type: ignore
             text="❌ Возникла ошибка при выдачи подписки попробуйте позже.",
             reply_markup=BackButton.back_start()
         )
-        return
-    
-    data = await to_link(res) #type: ignore
 
-    await callback.message.edit_text( #type: ignore
+    return callback.message.edit_text( #type: ignore
         text=text_reponse,
         reply_markup=SubMenu.links_keyboard(data.titles), #type: ignore
         parse_mode="MARKDOWN"
     )
 
-async def is_duplicate_callback(callback_id: str) -> bool:
-    """Проверяет, обрабатывали ли мы уже этот callback"""
-    key = f"callback_processed:{callback_id}"
-    redis = redis_module.redis_client
-
-    
-    # Если ключ существует - это дубликат
-    if await redis.exists(key): #type: ignore
-        return True
-    
-    # Сохраняем на 60 секунд (callback_id живёт недолго)
-    await redis.setex(key, 60, "1") #type: ignore
-    return False
-
 
 @dp.callback_query(F.data.startswith("sub_"))
 async def process_sub(callback: CallbackQuery):
-    if await is_duplicate_callback(callback.id):
+    if not (await idempotency.claim("callback", callback.id)).first:
         logger.warning(f"⚠️ Дубликат callback {callback.id} от {callback.from_user.id}")
         await callback.answer()  # просто отвечаем, чтобы убрать "часики"
         return
@@ -96,23 +78,16 @@ async def process_sub(callback: CallbackQuery):
     
 
     sub_url = f"{s.IN_SUB_LINK + uuid.uuid}" #type: ignore
-    res = await get_user_cached(user_id=user_id)
+    data = await get_user_cached(user_id=user_id)
 
-    if res is None:
+    if data is None:
         await callback.message.edit_text( #type: ignore
             text="❌ Возникла ошибка при выдачи подписки попробуйте позже.",
             reply_markup=BackButton.back_start()
         )
         return
 
-       
-    data = await to_link(res) #type: ignore
-    links_marz = data.links #type: ignore
-
-    uuid = await get_user_in_links(user_id=user_id)
-    sub_url = f"{s.IN_SUB_LINK + uuid.uuid}" #type: ignore
-
-    link = links_marz[int(sub_id)] #type: ignore
+    link = data.links[int(sub_id)]
     text_response = f"""🔐 <b>Ваши подписки IV VPN</b>
 
 📋 <b>Универсальная ссылка:</b>
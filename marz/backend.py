@@ -1,74 +1,216 @@
 # backend_context.py
 import aiohttp
 import asyncio
+import base64
+import json
+import time
+import orjson
+from dataclasses import dataclass
 from config_data.config import settings as s
 from logger_setup import logger
-from typing import Optional, Dict, Any
+from collections import deque
+from itertools import islice
+from typing import AsyncIterator, Optional, Dict, Any
+from urllib.parse import urlsplit
 
 
+# Долгоживущие keep-alive пулы соединений, по одному на панель (origin)
+_sessions: Dict[str, aiohttp.ClientSession] = {}
+
+
+def _origin(url: str) -> str:
+    """scheme://host[:port] - ключ пула"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(url: str) -> aiohttp.ClientSession:
+    """Вернуть пул для панели, создать при первом обращении"""
+    key = _origin(url)
+    session = _sessions.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=s.MARZ_POOL_LIMIT,
+            limit_per_host=s.MARZ_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=s.MARZ_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=s.MARZ_DNS_TTL,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+        _sessions[key] = session
+        logger.debug(f"Открыт пул соединений {key}")
+    return session
+
+
+async def init_sessions(*urls: str) -> None:
+    """Открыть пулы заранее (вызывается из lifespan)"""
+    for url in urls:
+        get_session(url)
+
+
+async def close_sessions() -> None:
+    """Закрыть все пулы (вызывается из lifespan)"""
+    for key, session in list(_sessions.items()):
+        if not session.closed:
+            await session.close()
+        logger.debug(f"Закрыт пул соединений {key}")
+    _sessions.clear()
+
+
+# Поля пользователя, которые отдаёт iter_users по умолчанию
+USER_FIELDS = ("username", "status", "expire", "subscription_url", "links")
+
+
+@dataclass(slots=True)
+class _Token:
+    value: str
+    expires_at: float
+
+
+# Кэш токенов и текущие логины, по одному на панель
+_tokens: Dict[str, _Token] = {}
+_logins: Dict[str, asyncio.Task] = {}
+
+TOKEN_REFRESH_MARGIN = 120  # за сколько секунд до истечения обновлять в фоне
+TOKEN_DEFAULT_TTL = 600     # если в JWT нет exp
+
+
+def _jwt_exp(token: str) -> float | None:
+    """Достаёт exp из payload JWT без проверки подписи"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+def _log_login_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception():
+        logger.warning(f"Фоновое обновление токена не удалось: {task.exception()}")
+
 
 class MarzbanClient:
     """Клиент с синглтоном ПО URL"""
     
-    def __init__(self, url: str):
+    def __init__(self, url: str, max_attempts: int = 5):
         self.user = s.M_DIGITAL_U
         self.password = s.M_DIGITAL_P
         self.base_url = url
         self.timeout = aiohttp.ClientTimeout(total=30)
+        self.max_attempts = max_attempts  # попыток на запрос к API (не считая логина)
     
 
-    async def _make_request(self, method: str, endpoint: str, **kwargs) -> Optional[Dict[str, Any]]:
-        max_attempts = 5
+    async def _make_request(self, method: str, endpoint: str, auth: bool = True, **kwargs) -> Optional[Dict[str, Any]]:
+        max_attempts = self.max_attempts
         delay = 1
-        
-        for attempt in range(max_attempts):
+        relogged = False
+        token = None
+        attempt = 0
+
+        while attempt < max_attempts:
+            pause = 0
             try:
-                async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                    async with session.request(
-                        method,
-                        f"{self.base_url}{endpoint}",
-                        **kwargs
-                    ) as response:
-                        # Успех
-                        if response.status in (200, 201, 204):
-                            if method == "DELETE":
-                                return {"success": True}
-                            return await response.json()
-                        
-                        # 404 от Xray fallback - retry!
-                        elif response.status == 404 and attempt < max_attempts - 1:
-                            body = await response.text()
-                            # Проверяем, это fallback или реальный 404
-                            if 'kittenx' in body or 'Not Found' in body:
-                                logger.warning(f"Xray fallback, retry {attempt + 1}/{max_attempts}")
-                                if attempt % 3 == 0 and attempt != 0:
-                                    await asyncio.sleep(delay * 20 * (attempt + 1))
-                                await asyncio.sleep(delay * (attempt + 1))
-                                continue
-                            else:
-                                return None
-                        
-                        # Серверные ошибки - retry
-                        elif 500 <= response.status < 600 and attempt < max_attempts - 1:
-                            logger.warning(f"Retry {attempt + 1}/{max_attempts}: {response.status}")
-                            await asyncio.sleep(delay * (attempt + 1))
-                            continue
-                        
+                if auth:
+                    token = await self._token()
+                    kwargs["headers"] = {
+                        **kwargs.get("headers", {}),
+                        "accept": "application/json",
+                        "Authorization": f"Bearer {token}"
+                    }
+
+                session = get_session(self.base_url)
+                async with session.request(
+                    method,
+                    f"{self.base_url}{endpoint}",
+                    timeout=self.timeout,
+                    **kwargs
+                ) as response:
+                    # Успех
+                    if response.status in (200, 201, 204):
+                        if method == "DELETE":
+                            return {"success": True}
+                        return await response.json(loads=orjson.loads)
+
+                    # Токен отозван/истёк раньше exp - один раз перелогиниваемся
+                    # и повторяем запрос, попытка при этом не тратится
+                    elif response.status == 401 and auth and not relogged:
+                        logger.warning(f"401 от {self.base_url}, обновляю токен")
+                        await self._token(stale=token)
+                        relogged = True
+                        continue
+
+                    # 404 от Xray fallback - retry!
+                    elif response.status == 404 and attempt < max_attempts - 1:
+                        body = await response.text()
+                        # Проверяем, это fallback или реальный 404
+                        if 'kittenx' in body or 'Not Found' in body:
+                            logger.warning(f"Xray fallback, retry {attempt + 1}/{max_attempts}")
+                            if attempt % 3 == 0 and attempt != 0:
+                                pause += delay * 20 * (attempt + 1)
+                            pause += delay * (attempt + 1)
                         else:
-                            logger.warning(f"Ошибка {response.status}")
                             return None
-            
+
+                    # Серверные ошибки - retry
+                    elif 500 <= response.status < 600 and attempt < max_attempts - 1:
+                        logger.warning(f"Retry {attempt + 1}/{max_attempts}: {response.status}")
+                        pause = delay * (attempt + 1)
+
+                    else:
+                        logger.warning(f"Ошибка {response.status}")
+                        return None
+
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 e = str(e)
                 if attempt < max_attempts - 1:
                     logger.warning(f"Retry {attempt + 1}/{max_attempts}: {e[:20]}")
-                    await asyncio.sleep(delay * (attempt + 1))
+                    pause = delay * (attempt + 1)
                 else:
                     logger.error(f"Все попытки исчерпаны: {e[:20]}")
                     return None
-        
+
+            # Ждём уже после того, как соединение вернулось в пул
+            await asyncio.sleep(pause)
+            attempt += 1
+
         return None
-    
+
+    async def _token(self, stale: str | None = None) -> str:
+        """
+        Токен из кэша панели.
+        За TOKEN_REFRESH_MARGIN до истечения запускается фоновое обновление,
+        а все конкурентные вызовы ждут один и тот же логин.
+        stale - токен, на который панель ответила 401: его больше не отдаём.
+        """
+        cached = _tokens.get(self.base_url)
+        now = time.time()
+
+        if cached and cached.value != stale and now < cached.expires_at:
+            if now >= cached.expires_at - TOKEN_REFRESH_MARGIN:
+                self._login()
+            return cached.value
+
+        return await asyncio.shield(self._login())
+
+    def _login(self) -> asyncio.Task:
+        """Single-flight логин: один запрос токена на панель в момент времени"""
+        task = _logins.get(self.base_url)
+        if task is None or task.done():
+            task = asyncio.create_task(self._fetch_token())
+            task.add_done_callback(_log_login_error)
+            _logins[self.base_url] = task
+        return task
+
+    async def _fetch_token(self) -> str:
+        token = await self._get_token()
+        expires_at = _jwt_exp(token) or time.time() + TOKEN_DEFAULT_TTL
+        _tokens[self.base_url] = _Token(value=token, expires_at=expires_at)
+        logger.debug(f"Токен {self.base_url} обновлён, действует до {expires_at:.0f}")
+        return token
+
     async def _get_token(self) -> str:
         """Получить токен с retry"""
         max_attempts = 15
@@ -81,23 +223,24 @@ class MarzbanClient:
         
         for attempt in range(max_attempts):
             try:
-                async with aiohttp.ClientSession(timeout=self.timeout) as session:
-                    async with session.post(
-                        url=f"{self.base_url}/api/admin/token",
-                        data=data
-                    ) as response:
-                        if response.status == 200:
-                            json_data = await response.json()
-                            return json_data["access_token"]
-                        elif attempt < max_attempts - 1:
-                            logger.warning(f"Token retry {attempt + 1}: статус {response.status}")
-                            if attempt % 5 == 0:
-                                await asyncio.sleep(delay * 20 * (attempt + 1))
-                            else:
-                                await asyncio.sleep(delay * (attempt + 1))
-                            continue
+                session = get_session(self.base_url)
+                async with session.post(
+                    url=f"{self.base_url}/api/admin/token",
+                    data=data,
+                    timeout=self.timeout
+                ) as response:
+                    if response.status == 200:
+                        json_data = await response.json()
+                        return json_data["access_token"]
+                    elif attempt < max_attempts - 1:
+                        logger.warning(f"Token retry {attempt + 1}: статус {response.status}")
+                        if attempt % 5 == 0:
+                            await asyncio.sleep(delay * 20 * (attempt + 1))
                         else:
-                            raise Exception(f"Failed to get token: {response.status}")
+                            await asyncio.sleep(delay * (attempt + 1))
+                        continue
+                    else:
+                        raise Exception(f"Failed to get token: {response.status}")
             
             except aiohttp.ClientError as e:
                 e = str(e)
@@ -113,12 +256,7 @@ class MarzbanClient:
 
     
     async def get_user(self, user_id: str) -> Optional[Dict[str, Any]]:
-        token = await self._get_token()
-        headers = {
-                "accept": "application/json",
-                "Authorization": f"Bearer {token}"
-        }
-        return await self._make_request(method="GET", endpoint=f"/api/user/{user_id}", headers=headers)
+        return await self._make_request(method="GET", endpoint=f"/api/user/{user_id}")
 
         # """Получить информацию о пользователе"""
     
@@ -148,18 +286,16 @@ class MarzbanClient:
         #     logger.error(f"Исключение при получении пользователя {user_id}: {e}")
         #     return None
     
-    async def modify_user(self, user_id: str, expire: int):
-        """Изменить данные пользователя"""
+    async def modify_user(self, user_id: str, expire: int | None = None, inbounds: list | None = None):
+        """Изменить данные пользователя (None - поле не меняется)"""
         try:
-            token = await self._get_token()
-            headers = {
-                "accept": "application/json",
-                "Authorization": f"Bearer {token}"
-            }
+            data: Dict[str, Any] = {}
+            if expire is not None:
+                data["expire"] = expire
+            if inbounds is not None:
+                data["inbounds"] = {"vless": inbounds}
             
-            data = {"expire": expire}
-            
-            return await self._make_request(method="PUT", endpoint=f'/api/user/{user_id}', headers=headers, json=data)
+            return await self._make_request(method="PUT", endpoint=f'/api/user/{user_id}', json=data)
 
             # async with aiohttp.ClientSession(timeout=self.timeout) as session:
             #     async with session.put(
@@ -184,13 +320,6 @@ class MarzbanClient:
     async def create_user(self, username: str) -> Optional[Dict[str, Any]]:
         """Создать нового пользователя"""
         try:
-            token = await self._get_token()
-            headers = {
-                "accept": "application/json",
-                "Authorization": f"Bearer {token}"
-            }
-            
-
             username = str(username)
             
             data = {
@@ -205,7 +334,7 @@ class MarzbanClient:
                 }
             }
 
-            return await self._make_request(method="POST", endpoint="/api/user", headers=headers, json=data)
+            return await self._make_request(method="POST", endpoint="/api/user", json=data)
             
             # async with aiohttp.ClientSession(timeout=self.timeout) as session:
             #     async with session.post(
@@ -231,12 +360,6 @@ class MarzbanClient:
     async def create_user_options(self, username: str, id: str | None = None, inbounds: list | None = None, expire: int | None = None) -> Optional[Dict[str, Any]]:
         """Создать нового пользователя"""
         try:
-            token = await self._get_token()
-            headers = {
-                "accept": "application/json",
-                "Authorization": f"Bearer {token}"
-            }
-            
             username = str(username)
 
             data = {
@@ -261,7 +384,7 @@ class MarzbanClient:
                 data['expire'] = expire
             
 
-            return await self._make_request(method="POST", endpoint="/api/user", headers=headers, json=data)
+            return await self._make_request(method="POST", endpoint="/api/user", json=data)
         
             # async with aiohttp.ClientSession(timeout=self.timeout) as session:
             #     async with session.post(
@@ -289,13 +412,7 @@ class MarzbanClient:
     async def delete_user(self, username: str) -> dict | None:
         """Удалить пользователя"""
         try:
-            token = await self._get_token()
-            headers = {
-                "accept": "application/json",
-                "Authorization": f"Bearer {token}"
-            }
-
-            return await self._make_request(method="DELETE", endpoint=f'/api/user/{username}', headers=headers)
+            return await self._make_request(method="DELETE", endpoint=f'/api/user/{username}')
             
             # async with aiohttp.ClientSession(timeout=self.timeout) as session:
             #     async with session.delete(
@@ -315,13 +432,61 @@ class MarzbanClient:
             logger.error(f"Исключение при удалении пользователя {username}: {e}")
             return None
     
-    async def get_users(self) -> Optional[Dict[str, Any]]:
-        token = await self._get_token()
-        headers = {
-                "accept": "application/json",
-                "Authorization": f"Bearer {token}"
-        }
-        return await self._make_request(method="GET", endpoint=f"/api/users", headers=headers)
+    async def get_users(self, **params) -> Optional[Dict[str, Any]]:
+        """Список пользователей; params - offset, limit, sort, status, username"""
+        return await self._make_request(method="GET", endpoint=f"/api/users", params=params)
+
+    async def count_users(self) -> Optional[int]:
+        """Только total: запрашиваем одну строку вместо всего списка"""
+        res = await self.get_users(offset=0, limit=1)
+        if res is None:
+            return None
+        return res.get("total")
+
+    async def iter_users(
+        self,
+        page_size: int | None = None,
+        prefetch: int = 2,
+        fields: tuple[str, ...] = USER_FIELDS,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Все пользователи панели постранично (offset/limit), по одному.
+        Вперёд загружается не больше prefetch страниц, от каждого
+        пользователя остаются только fields - память не зависит от
+        числа пользователей. Страница не загрузилась - RuntimeError.
+        """
+        page_size = page_size or s.MARZ_USERS_PAGE
+
+        async def page(offset: int) -> list[Dict[str, Any]]:
+            res = await self.get_users(offset=offset, limit=page_size, sort="created_at")
+            if res is None:
+                raise RuntimeError(f"Failed to fetch users page offset={offset}")
+            return [{field: user.get(field) for field in fields} for user in res.get("users", [])]
+
+        first = await self.get_users(offset=0, limit=page_size, sort="created_at")
+        if first is None:
+            raise RuntimeError("Failed to fetch users page offset=0")
+        total = first.get("total", 0)
+        users = [{field: user.get(field) for field in fields} for user in first.get("users", [])]
+        del first
+
+        offsets = iter(range(page_size, total, page_size))
+        pending: deque[asyncio.Task] = deque(
+            asyncio.create_task(page(offset)) for offset in islice(offsets, prefetch)
+        )
+        try:
+            while True:
+                for user in users:
+                    yield user
+                if not pending:
+                    return
+                users = await pending.popleft()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(asyncio.create_task(page(offset)))
+        finally:
+            for task in pending:
+                task.cancel()
 
 
     async def health_check(self) -> bool:
@@ -329,12 +494,12 @@ class MarzbanClient:
             try:
                 timeout = aiohttp.ClientTimeout(total=5)
                 
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    # HEAD запрос = минимальный трафик
-                    async with session.head(url=self.base_url) as response:
-                        # Любой HTTP ответ = сервер жив
-                        logger.debug(f'Панель {self.base_url} доступна (статус {response.status})')
-                        return True
+                session = get_session(self.base_url)
+                # HEAD запрос = минимальный трафик
+                async with session.head(url=self.base_url, timeout=timeout) as response:
+                    # Любой HTTP ответ = сервер жив
+                    logger.debug(f'Панель {self.base_url} доступна (статус {response.status})')
+                    return True
             
             except Exception as e:
                 logger.warning(f'Панель {self.base_url} недоступна: {e}')
@@ -342,12 +507,7 @@ class MarzbanClient:
     
     async def health_check_custom(self) -> bool:
         """Проверка доступности панели (TCP уровень)"""
-        token = await self._get_token()
-        headers = {
-                "accept": "application/json",
-                "Authorization": f"Bearer {token}"
-        }
-        res = await self._make_request(method="GET", endpoint='/api/core', headers=headers)
+        res = await self._make_request(method="GET", endpoint='/api/core')
         logger.debug(res)
         if res:
             return True
@@ -0,0 +1,343 @@
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import orjson
+
+import app.redis_client as redis_module
+from config_data.config import settings, PanelConfig
+from logger_setup import logger
+from marz import panels
+from marz.backend import MarzbanClient
+from misc import user_cache
+
+
+# Состояние задачи в Redis: hash с параметрами и счётчиками, план по панели
+# (hash username -> аргументы modify_user), множество обработанных username
+# по панели (для продолжения) и список ошибок
+JOB_PREFIX = "bulk:"
+ERRORS_KEEP = 50
+PLAN_CHUNK = 1000
+
+# Поля пользователя, нужные операциям
+FIELDS = ("username", "status", "expire", "inbounds")
+
+
+# Операция: по записям пользователя на всех панелях {панель: пользователь}
+# возвращает аргументы modify_user по панелям (панели без изменений - не
+# в ответе). Цель абсолютная - итоговое значение, а не "+N": повтор запроса
+# и эхо живой репликации между панелями ничего не удваивают
+Operation = Callable[[dict[str, dict], str], dict[str, dict[str, Any]]]
+
+
+def _extend(records: dict[str, dict], arg: str) -> dict[str, dict[str, Any]]:
+    """Продлить на arg дней от самого позднего expire среди панелей (бессрочных не трогаем)"""
+    limited = [panel for panel, user in records.items() if user.get("expire")]
+    if not limited:
+        return {}
+    target = max(records[panel]["expire"] for panel in limited) + int(arg) * 86400
+    return {panel: {"expire": target} for panel in limited}
+
+
+def _add_inbound(records: dict[str, dict], arg: str) -> dict[str, dict[str, Any]]:
+    """Добавить inbound arg в vless (expire не передаём - панель его не меняет)"""
+    targets = {}
+    for panel, user in records.items():
+        inbounds = list((user.get("inbounds") or {}).get("vless") or [])
+        if arg not in inbounds:
+            targets[panel] = {"inbounds": inbounds + [arg]}
+    return targets
+
+
+OPERATIONS: dict[str, Operation] = {
+    "extend": _extend,
+    "inbound": _add_inbound,
+}
+
+
+@dataclass(slots=True)
+class JobSpec:
+    op: str
+    arg: str
+    status: str = "all"  # фильтр по статусу пользователя Marzban
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex[:8])
+
+
+@dataclass(slots=True)
+class PanelStats:
+    ok: int = 0
+    failed: int = 0
+    skipped: int = 0
+    requests: int = 0  # запросов к панели в этом запуске
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+
+@dataclass(slots=True)
+class JobReport:
+    spec: JobSpec
+    panels: dict[str, PanelStats] = field(default_factory=dict)
+    errors: list[str] = field(default_factory=list)
+    resumed: bool = False
+
+    def summary(self) -> str:
+        lines = [f"Задача {self.spec.job_id}: {self.spec.op} {self.spec.arg} ({self.spec.status})"
+                 f"{' - продолжение' if self.resumed else ''}"]
+        for name, st in self.panels.items():
+            lines.append(
+                f"{name}: успешно {st.ok}, ошибок {st.failed}, без изменений {st.skipped}, "
+                f"{st.elapsed:.0f} сек, {st.rate:.1f} оп/сек"
+            )
+        if self.errors:
+            lines.append("Ошибки:")
+            lines.extend(self.errors[:10])
+        return "\n".join(lines)
+
+
+class RateLimiter:
+    """Не чаще rate операций в секунду (rate <= 0 - без ограничения)"""
+
+    __slots__ = ("interval", "_next")
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        slot = max(self._next, now)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _key(job_id: str, *parts: str) -> str:
+    return ":".join((JOB_PREFIX + job_id, *parts))
+
+
+async def _save_spec(spec: JobSpec) -> None:
+    redis = redis_module.redis_client
+    await redis.hset(_key(spec.job_id), mapping={ #type: ignore
+        "op": spec.op, "arg": spec.arg, "status": spec.status, "state": "running",
+    })
+    await redis.expire(_key(spec.job_id), settings.BULK_JOB_TTL) #type: ignore
+
+
+async def load_spec(job_id: str) -> JobSpec | None:
+    data = await redis_module.redis_client.hgetall(_key(job_id)) #type: ignore
+    if not data:
+        return None
+    return JobSpec(op=data["op"], arg=data["arg"], status=data["status"], job_id=job_id)
+
+
+async def _checkpoint(spec: JobSpec, panel: str, usernames: list[str], stats: PanelStats, errors: list[str]) -> None:
+    """Сохранить прогресс пачки: отмеченные пользователи при продолжении пропускаются"""
+    redis = redis_module.redis_client
+    async with redis.pipeline(transaction=True) as pipe: #type: ignore
+        if usernames:
+            pipe.sadd(_key(spec.job_id, "done", panel), *usernames)
+            pipe.expire(_key(spec.job_id, "done", panel), settings.BULK_JOB_TTL)
+        pipe.hset(_key(spec.job_id), mapping={
+            f"ok:{panel}": stats.ok, f"failed:{panel}": stats.failed, f"skipped:{panel}": stats.skipped,
+        })
+        if errors:
+            pipe.lpush(_key(spec.job_id, "errors"), *errors)
+            pipe.ltrim(_key(spec.job_id, "errors"), 0, ERRORS_KEEP - 1)
+            pipe.expire(_key(spec.job_id, "errors"), settings.BULK_JOB_TTL)
+        await pipe.execute()
+
+
+async def _snapshot(panel: PanelConfig) -> dict[str, dict]:
+    client = MarzbanClient(panel.url, max_attempts=3)
+    return {str(user["username"]): user async for user in client.iter_users(fields=FIELDS)}
+
+
+async def _plan(spec: JobSpec) -> None:
+    '''
+    Снимок всех панелей до первой записи и цели по нему.
+    Пользователь попадает в задачу, если статус хотя бы на одной панели
+    совпал с фильтром. План пишется в Redis одной транзакцией вместе
+    с отметкой planned: продолжение берёт его как есть и панели заново
+    не читает - записи задачи и живая репликация снимок уже не исказят.
+    '''
+    operation = OPERATIONS[spec.op]
+    names = list(panels.PANELS)
+    snapshots = dict(zip(names, await asyncio.gather(*[_snapshot(panel) for panel in panels.PANELS.values()])))
+
+    plans: dict[str, dict[str, str]] = {name: {} for name in names}
+    skipped = dict.fromkeys(names, 0)
+    for username in set().union(*snapshots.values()):
+        records = {name: snapshot[username] for name, snapshot in snapshots.items() if username in snapshot}
+        if spec.status != "all" and not any(user.get("status") == spec.status for user in records.values()):
+            continue
+        targets = operation(records, spec.arg)
+        for name in records:
+            if name in targets:
+                plans[name][username] = orjson.dumps(targets[name]).decode()
+            else:
+                skipped[name] += 1
+    del snapshots
+
+    redis = redis_module.redis_client
+    async with redis.pipeline(transaction=True) as pipe: #type: ignore
+        for name, plan in plans.items():
+            key = _key(spec.job_id, "plan", name)
+            pipe.delete(key)
+            items = list(plan.items())
+            for i in range(0, len(items), PLAN_CHUNK):
+                pipe.hset(key, mapping=dict(items[i:i + PLAN_CHUNK]))
+            pipe.expire(key, settings.BULK_JOB_TTL)
+        pipe.hset(_key(spec.job_id), mapping={
+            **{f"skipped:{name}": count for name, count in skipped.items()},
+            **{f"planned:{name}": len(plan) for name, plan in plans.items()},
+            "planned": 1,
+        })
+        await pipe.execute()
+    logger.info(f"bulk {spec.job_id}: план {', '.join(f'{name} {len(plan)}' for name, plan in plans.items())}")
+
+
+async def _run_panel(spec: JobSpec, panel: PanelConfig, report: JobReport) -> None:
+    '''
+    План задачи для одной панели.
+    Пачками по MARZ_USERS_PAGE: внутри пачки не больше BULK_PER_PANEL
+    запросов одновременно и не чаще BULK_RATE в секунду; после пачки - чекпоинт.
+    При продолжении успешные берутся из Redis, ошибки считаются заново.
+    '''
+    client = MarzbanClient(panel.url, max_attempts=3)
+    limit = asyncio.Semaphore(settings.BULK_PER_PANEL)
+    limiter = RateLimiter(settings.BULK_RATE)
+    redis = redis_module.redis_client
+
+    stats = PanelStats()
+    plan_key = _key(spec.job_id, "plan", panel.name)
+    done_key = _key(spec.job_id, "done", panel.name)
+    saved = await redis.hgetall(_key(spec.job_id)) #type: ignore
+    stats.ok = int(saved.get(f"ok:{panel.name}", 0))
+    stats.skipped = int(saved.get(f"skipped:{panel.name}", 0))
+    report.panels[panel.name] = stats
+    started = time.monotonic()
+
+    async def apply(username: str, kwargs: dict[str, Any], errors: list[str]) -> str | None:
+        """Username, если панель приняла запись"""
+        async with limit:
+            await limiter.wait()
+            stats.requests += 1
+            try:
+                res = await client.modify_user(user_id=username, **kwargs)
+            except Exception as e:
+                res = None
+                logger.warning(f"bulk {spec.job_id} {panel.name} {username}: {e}")
+        if res is None:
+            stats.failed += 1
+            errors.append(f"{panel.name}:{username}")
+            return None
+        # Отмечаем сразу: продолжение после сбоя не повторит запрос
+        await redis.sadd(done_key, username) #type: ignore
+        stats.ok += 1
+        return username
+
+    async def flush(batch: dict[str, str]) -> None:
+        errors: list[str] = []
+        usernames = list(batch)
+        flags = await redis.smismember(done_key, usernames) #type: ignore
+        todo = [username for username, done in zip(usernames, flags) if not done]
+        results = await asyncio.gather(*[apply(username, orjson.loads(batch[username]), errors) for username in todo])
+        # Неудачные не отмечаем: продолжение задачи повторит их
+        done = [username for username in results if username is not None]
+        stats.elapsed = time.monotonic() - started
+        report.errors.extend(errors)
+        await _checkpoint(spec, panel.name, done, stats, errors)
+        await user_cache.invalidate(*done)
+
+    cursor = 0
+    while True:
+        cursor, batch = await redis.hscan(plan_key, cursor, count=settings.MARZ_USERS_PAGE) #type: ignore
+        if batch:
+            await flush(batch)
+        if not cursor:
+            break
+    stats.elapsed = time.monotonic() - started
+
+
+async def run(spec: JobSpec, resumed: bool = False) -> JobReport:
+    '''
+    Сначала снимок всех панелей и план с абсолютными целями (_plan),
+    потом план выполняется на всех панелях параллельно.
+    Прогресс сохраняется в Redis: run(load_spec(job_id), resumed=True)
+    продолжает с места остановки, не повторяя уже сделанное; снимок
+    делается заново, только если прошлый запуск не успел сохранить план.
+    '''
+    if spec.op not in OPERATIONS:
+        raise ValueError(f"Unknown bulk operation: {spec.op}")
+    report = JobReport(spec=spec, resumed=resumed)
+    if not resumed:
+        await _save_spec(spec)
+
+    redis = redis_module.redis_client
+    state = "done"
+    try:
+        if not await redis.hget(_key(spec.job_id), "planned"): #type: ignore
+            await _plan(spec)
+    except Exception as e:
+        state = "interrupted"
+        report.errors.append(f"снимок панелей: прервано ({e})")
+        logger.error(f"bulk {spec.job_id}: не удалось составить план: {e}")
+    else:
+        results = await asyncio.gather(
+            *[_run_panel(spec, panel, report) for panel in panels.PANELS.values()],
+            return_exceptions=True,
+        )
+        for panel, res in zip(panels.PANELS, results):
+            if isinstance(res, BaseException):
+                state = "interrupted"
+                report.errors.append(f"{panel}: прервано ({res})")
+                logger.error(f"bulk {spec.job_id} на {panel} прервано: {res}")
+
+    await redis.hset(_key(spec.job_id), "state", state) #type: ignore
+    logger.info(report.summary())
+    return report
+
+
+async def status(job_id: str) -> str | None:
+    """Прогресс задачи из Redis"""
+    redis = redis_module.redis_client
+    data = await redis.hgetall(_key(job_id)) #type: ignore
+    if not data:
+        return None
+    lines = [f"Задача {job_id}: {data['op']} {data['arg']} ({data['status']}) - {data['state']}"]
+    for name in panels.names():
+        done = await redis.scard(_key(job_id, "done", name)) #type: ignore
+        lines.append(
+            f"{name}: обработано {done} из {data.get(f'planned:{name}', '?')}, успешно {data.get(f'ok:{name}', 0)}, "
+            f"ошибок {data.get(f'failed:{name}', 0)}"
+        )
+    return "\n".join(lines)
+
+
+# Запущенные задачи держим, чтобы их не собрал GC
+_running: dict[str, asyncio.Task] = {}
+
+
+def start(spec: JobSpec, resumed: bool = False, on_done: Callable[[JobReport], Any] | None = None) -> asyncio.Task:
+    """Запустить задачу в фоне; on_done(report) - корутина-колбэк (например, отчёт админу)"""
+    async def job() -> JobReport:
+        report = await run(spec, resumed=resumed)
+        if on_done is not None:
+            await on_done(report)
+        return report
+
+    task = asyncio.create_task(job())
+    _running[spec.job_id] = task
+    task.add_done_callback(lambda _: _running.pop(spec.job_id, None))
+    return task
+
+
+def is_running(job_id: str) -> bool:
+    return job_id in _running
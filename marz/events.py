@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+
+import orjson
+
+from config_data.config import settings
+from logger_setup import logger
+from marz import outbox, panels, replication
+from misc import idempotency, read_model, user_cache, versions
+from misc.utils import save_links
+
+
+# Поля уведомления Marzban, которые меняются при повторной отправке
+RESEND_FIELDS = ("send_at", "tries")
+
+
+def dedupe_key(event: dict) -> str | None:
+    '''
+    Ключ повторной доставки одного и того же уведомления.
+    Для create/update - хэш всего события без RESEND_FIELDS: в нём
+    enqueued_at, так что правка A -> B -> A за минуту - три разных события.
+    Без enqueued_at повтор от новой правки не отличить - такие события
+    не отбрасываются (None): запись в панели и так идемпотентна.
+    '''
+    key = event['username']
+    if event["action"] in replication.REPLICATED_ACTIONS:
+        if not event.get("enqueued_at"):
+            return None
+        raw = {k: v for k, v in event.items() if k not in RESEND_FIELDS and k != versions.EVENT_FIELD}
+        state = orjson.dumps(raw, option=orjson.OPT_SORT_KEYS, default=str)
+        key += ":" + hashlib.blake2b(state, digest_size=8).hexdigest()
+    return key
+
+
+async def claim(events: list[dict]) -> list[dict]:
+    '''
+    Отбрасывает повторные доставки одним запросом в Redis (misc.idempotency,
+    TTL по типу события). Повтор внутри одной пачки тоже считается дублем.
+    '''
+    if not events:
+        return events
+    keyed = [(event, dedupe_key(event)) for event in events]
+    claims = iter(await idempotency.claim_many(
+        [(f"marzban:{event['action']}", key) for event, key in keyed if key is not None]
+    ))
+
+    fresh = []
+    for event, key in keyed:
+        if key is None or next(claims).first:
+            fresh.append(event)
+        else:
+            logger.info(f'Дублирование операции {event["action"]} для {event["username"]}')
+    return fresh
+
+
+# События, после которых кэш пользователя (misc.user_cache) устарел
+INVALIDATING_ACTIONS = ("user_created", "user_updated", "user_expired")
+
+
+def group_by_user(events: list[dict]) -> dict[str, list[dict]]:
+    """События по пользователям, порядок внутри пользователя сохраняется"""
+    groups: dict[str, list[dict]] = {}
+    for event in events:
+        groups.setdefault(event["username"], []).append(event)
+    return groups
+
+
+async def _process_user(events: list[dict], limit: asyncio.Semaphore) -> tuple[dict[str, str], list[dict]]:
+    '''
+    События одного пользователя строго по очереди.
+    Запись в другие панели не делается здесь, а ставится в outbox.
+    Возвращает ссылку исходной панели и задания outbox.
+    '''
+    links: dict[str, str] = {}
+    jobs: dict[str, dict] = {}
+    async with limit:
+        for event in events:
+            action = event["action"]
+            if action in replication.REPLICATED_ACTIONS:
+                source = replication.source_panel(event)
+                sub_url = event["user"]["subscription_url"]
+                if source:
+                    links[source] = sub_url
+                # Более позднее событие по той же панели заменяет раннее
+                for panel in panels.others(source):
+                    jobs[panel.name] = outbox.job(event, panel.name)
+
+            elif action == 'user_expired':
+                logger.info(f'Отправить сообщение юзеру {event["username"]}')
+
+            elif action == 'reached_days_left':
+                logger.info(f'Отправить сообщение юзеру {event["username"]} День остался')
+    return links, list(jobs.values())
+
+
+async def process_batch(events: list[dict], dedupe: bool = True) -> dict:
+    '''
+    Обрабатывает всю пачку вебхука Marzban:
+    дубли отсекаются одним pipeline, разные пользователи идут параллельно,
+    события одного пользователя - по порядку. Записи в остальные панели
+    одним запросом уходят в outbox (их применяет outbox.run_worker),
+    ссылки исходных панелей сохраняются в БД одной записью.
+    dedupe=False - для повторной обработки (reclaim из стрима, replay),
+    когда ключи дублей уже выставлены первой попыткой.
+    '''
+    fresh = await claim(events) if dedupe else events
+    # Не из стрима (Redis недоступен) - версия по времени приёма
+    for event in fresh:
+        event.setdefault(versions.EVENT_FIELD, versions.now())
+    groups = group_by_user(fresh)
+    limit = asyncio.Semaphore(settings.EVENTS_CONCURRENCY)
+
+    usernames = list(groups)
+    results = await asyncio.gather(
+        *[_process_user(groups[username], limit) for username in usernames],
+        return_exceptions=True,
+    )
+
+    new_links: dict[str, dict[str, str]] = {}
+    jobs: list[dict] = []
+    for username, res in zip(usernames, results):
+        if isinstance(res, BaseException):
+            logger.error(f'Ошибка обработки событий {username}: {res}')
+            continue
+        links, user_jobs = res
+        if links:
+            new_links[username] = links
+        jobs.extend(user_jobs)
+
+    # Сначала локальная модель, потом сброс кэша - перечитается уже новое
+    try:
+        await read_model.save(read_model.from_events(fresh))
+    except Exception as e:
+        logger.error(f'Не удалось обновить модель подписок: {e}')
+
+    stale = [
+        username for username, user_events in groups.items()
+        if any(event["action"] in INVALIDATING_ACTIONS for event in user_events)
+    ]
+    try:
+        await user_cache.invalidate(*stale)
+    except Exception as e:
+        logger.error(f'Не удалось сбросить кэш пользователей: {e}')
+
+    queued = await outbox.enqueue(jobs)
+
+    try:
+        await save_links(new_links)
+    except Exception as e:
+        logger.error(f'Ошибка при добавленни ссылок в БД {e}')
+
+    logger.debug(f'Пачка Marzban: {len(events)} событий, {len(fresh)} новых, {len(groups)} пользователей')
+    return {"received": len(events), "processed": len(fresh), "users": len(groups), "queued": queued}
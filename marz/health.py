@@ -0,0 +1,227 @@
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+from dataclasses import dataclass, asdict
+from typing import Awaitable
+
+import aiohttp
+
+import app.redis_client as redis_module
+from config_data.config import settings as s
+from logger_setup import logger
+from marz import panels
+from marz.backend import get_session
+
+
+HEALTH_KEY = "panels:health"         # hash: панель -> json PanelHealth
+LEADER_KEY = "panels:health:leader"  # кто из воркеров сейчас опрашивает панели
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+@dataclass(slots=True)
+class PanelHealth:
+    name: str
+    up: bool
+    latency: float      # мс, последний замер
+    checked_at: float   # unix time
+    fails: int = 0      # неудачных проверок подряд
+    ewma_latency: float = 0.0  # мс, сглаженная задержка
+    error_rate: float = 0.0    # 0..1, сглаженная доля неудачных проверок
+
+
+# Состояние панелей в памяти воркера
+_state: dict[str, PanelHealth] = {}
+
+
+def get_state(name: str) -> PanelHealth | None:
+    """Свежее состояние панели или None, если данных нет/устарели"""
+    state = _state.get(name)
+    if state is None:
+        return None
+    if time.time() - state.checked_at > s.HEALTH_STALE_AFTER:
+        return None
+    return state
+
+
+def score(state: PanelHealth) -> float:
+    """Стоимость панели: задержка, умноженная на штраф за ошибки. Меньше - лучше"""
+    latency = max(state.ewma_latency, 1.0)
+    return latency * (1 + s.HEALTH_ERROR_PENALTY * state.error_rate)
+
+
+def pick_link(links: dict[str, str | None]) -> str | None:
+    '''
+    Выбирает ссылку подписки только по сохранённому состоянию, без запросов.
+    Среди живых по свежим данным монитора панелей выбор случайный,
+    с вероятностью пропорциональной weight / score: медленные и
+    ошибающиеся панели получают меньше обновлений подписок.
+    Возвращает None, если живых по данным монитора нет или данных нет вовсе.
+    '''
+    candidates: list[str] = []
+    weights: list[float] = []
+    for name, link in links.items():
+        if not link:
+            continue
+        state = get_state(name)
+        if state is None or not state.up:
+            continue
+        panel = panels.get(name)
+        weight = panel.weight if panel else 1.0
+        if weight <= 0:
+            continue
+        candidates.append(link)
+        weights.append(weight / score(state))
+
+    if not candidates:
+        return None
+    return random.choices(candidates, weights=weights)[0]
+
+
+def fallback_order(links: dict[str, str | None]) -> list[str]:
+    """Ссылки для живой проверки: сначала панели без данных, потом упавшие"""
+    known_down = [name for name in links if get_state(name) is not None]
+    unknown = [name for name in links if name not in known_down]
+    return [links[name] for name in unknown + known_down if links[name]] #type: ignore
+
+
+async def _check_link(link: str, delay: float) -> str | None:
+    """Проверить одну ссылку подписки (один запрос, без retry)"""
+    if delay:
+        await asyncio.sleep(delay)
+    timeout = aiohttp.ClientTimeout(total=s.HEALTH_TIMEOUT)
+    try:
+        async with get_session(link).get(link, timeout=timeout, allow_redirects=False) as response:
+            if response.status in (200, 201):
+                return link
+            logger.debug(f'Panel {link}: статус {response.status}')
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug(f'Panel {link} недоступна: {e}')
+    return None
+
+
+async def first_available(
+    links: list[str],
+    deadline: float,
+    hedge_delay: float,
+    abort: Awaitable | None = None,
+) -> str | None:
+    '''
+    Хеджированная проверка: первая ссылка проверяется сразу, каждая следующая -
+    через hedge_delay, если ответа ещё нет. Возвращает первую ответившую 200,
+    остальные проверки отменяются.
+    Всё прерывается по истечении deadline (сек) или когда завершается abort
+    (например, клиент отключился). Тогда возвращается None.
+    '''
+    loop = asyncio.get_running_loop()
+    until = loop.time() + deadline
+
+    probes = {asyncio.create_task(_check_link(link, i * hedge_delay)) for i, link in enumerate(links)}
+    watcher = asyncio.ensure_future(abort) if abort is not None else None
+    pending: set[asyncio.Future] = set(probes)
+    if watcher is not None:
+        pending.add(watcher)
+
+    try:
+        while probes & pending:
+            remaining = until - loop.time()
+            if remaining <= 0:
+                logger.warning(f'Проверка панелей не уложилась в {deadline}с')
+                return None
+
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if watcher is not None and watcher in done:
+                logger.debug('Клиент отключился, проверка панелей прервана')
+                return None
+
+            for task in done:
+                if not task.cancelled() and task.exception() is None and task.result():
+                    return task.result()
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def probe(name: str, url: str) -> PanelHealth:
+    """Одна проверка панели: любой HTTP ответ ниже 500 = жива"""
+    prev = _state.get(name)
+    fails = prev.fails if prev else 0
+    timeout = aiohttp.ClientTimeout(total=s.HEALTH_TIMEOUT)
+    started = time.perf_counter()
+    try:
+        async with get_session(url).head(url, timeout=timeout) as response:
+            up = response.status < 500
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug(f'Панель {name} не ответила: {e}')
+        up = False
+    latency = (time.perf_counter() - started) * 1000
+
+    # EWMA: задержку учитываем только по успешным проверкам
+    alpha = s.HEALTH_EWMA_ALPHA
+    ewma_latency = prev.ewma_latency if prev and prev.ewma_latency else latency
+    if up:
+        ewma_latency = alpha * latency + (1 - alpha) * ewma_latency
+    error_rate = (1 - alpha) * (prev.error_rate if prev else 0.0) + alpha * (0.0 if up else 1.0)
+
+    return PanelHealth(
+        name=name,
+        up=up,
+        latency=round(latency, 1),
+        checked_at=time.time(),
+        fails=0 if up else fails + 1,
+        ewma_latency=round(ewma_latency, 1),
+        error_rate=round(error_rate, 3),
+    )
+
+
+async def _is_leader() -> bool:
+    """Опрашивает панели только один воркер, остальные читают Redis"""
+    redis = redis_module.redis_client
+    if redis is None:
+        return True
+    ttl = max(int(s.HEALTH_INTERVAL * 3), 1)
+    if await redis.set(LEADER_KEY, WORKER_ID, nx=True, ex=ttl):
+        return True
+    if await redis.get(LEADER_KEY) == WORKER_ID:
+        await redis.expire(LEADER_KEY, ttl)
+        return True
+    return False
+
+
+async def _check_all() -> None:
+    results = await asyncio.gather(*[probe(panel.name, panel.url) for panel in panels.PANELS.values()])
+    for state in results:
+        prev = _state.get(state.name)
+        if prev is not None and prev.up != state.up:
+            logger.warning(f'Панель {state.name} {"поднялась" if state.up else "упала"}')
+        _state[state.name] = state
+
+    redis = redis_module.redis_client
+    if redis is not None:
+        await redis.hset(HEALTH_KEY, mapping={st.name: json.dumps(asdict(st)) for st in results}) #type: ignore
+        await redis.expire(HEALTH_KEY, int(s.HEALTH_STALE_AFTER))
+
+
+async def _load_from_redis() -> None:
+    raw = await redis_module.redis_client.hgetall(HEALTH_KEY) #type: ignore
+    for name, value in raw.items():
+        _state[name] = PanelHealth(**json.loads(value))
+
+
+async def run_monitor() -> None:
+    """Фоновая задача: держит состояние панелей актуальным"""
+    logger.info(f'Монитор панелей запущен ({WORKER_ID})')
+    while True:
+        try:
+            if await _is_leader():
+                await _check_all()
+            else:
+                await _load_from_redis()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f'Ошибка монитора панелей: {e}')
+        await asyncio.sleep(s.HEALTH_INTERVAL)
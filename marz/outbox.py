@@ -0,0 +1,212 @@
+import asyncio
+import random
+from datetime import timedelta
+
+from sqlalchemy import select, update, func, or_, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from config_data.config import settings
+from db.database import async_session
+from db.db_models import PanelQueue
+from logger_setup import logger
+from marz import panels, replication
+from misc import versions
+from misc.utils import save_links
+from repositories.base import BaseRepository
+
+
+def job(event: dict, panel: str) -> dict:
+    '''
+    Строка outbox из события Marzban для одной целевой панели.
+    user_updated откладывается на EVENTS_COALESCE_WINDOW: следующие
+    обновления того же пользователя за это время перезапишут строку,
+    и в панель уйдёт одно итоговое состояние.
+    '''
+    user = event["user"]
+    next_try_at = func.now()
+    if event["action"] == "user_updated":
+        next_try_at = next_try_at + timedelta(seconds=settings.EVENTS_COALESCE_WINDOW)
+    return {
+        "uuid": user["proxies"]["vless"]["id"],
+        "panel": panel,
+        "username": event["username"],
+        "expire": user["expire"],
+        "inbounds": list(user["inbounds"]["vless"]),
+        "action": event["action"],
+        "attempts": 0,
+        "next_try_at": next_try_at,
+        "last_error": None,
+        "version": event[versions.EVENT_FIELD],
+    }
+
+
+def to_event(row: PanelQueue) -> dict:
+    """Обратно в формат события Marzban для replication.apply"""
+    return {
+        "username": row.username,
+        "action": row.action,
+        "user": {
+            "proxies": {"vless": {"id": row.uuid}},
+            "inbounds": {"vless": list(row.inbounds)},
+            "expire": row.expire,
+        },
+    }
+
+
+def backoff(attempts: int) -> timedelta:
+    delay = min(settings.OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), settings.OUTBOX_BACKOFF_MAX)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+async def enqueue(jobs: list[dict]) -> int:
+    '''
+    Кладёт задания в outbox одним запросом.
+    На (username, panel) хранится одно задание: новое событие перезаписывает
+    состояние и сбрасывает счётчик попыток, но только событие не старше
+    записанного (version): консумеры стрима идут параллельно, и более
+    раннее событие может прийти вторым. Строка переживает запись в панель,
+    поэтому старое событие из reclaim или replay отбрасывается и после
+    того, как новое уже применено. Окно склейки продлевается
+    с каждым событием, но не дальше created_at + EVENTS_COALESCE_MAX_WAIT,
+    чтобы непрерывный поток правок не откладывал запись бесконечно.
+    '''
+    if not jobs:
+        return 0
+    excluded = insert(PanelQueue).excluded
+    async with async_session() as session:
+        repo = BaseRepository(session=session, model=PanelQueue)
+        return await repo.upsert_many(
+            jobs,
+            index_elements=["username", "panel"],
+            update_fields=["uuid", "expire", "inbounds", "action", "attempts", "last_error", "version"],
+            set_={
+                "next_try_at": func.least(
+                    excluded.next_try_at,
+                    PanelQueue.created_at + timedelta(seconds=settings.EVENTS_COALESCE_MAX_WAIT),
+                ),
+            },
+            where=PanelQueue.version <= excluded.version,
+        )
+
+
+async def lease() -> list:
+    '''
+    Короткой транзакцией берёт пачку готовых заданий в аренду:
+    FOR UPDATE SKIP LOCKED - несколько процессов делят очередь без
+    пересечений, leased_until = now() + OUTBOX_LEASE, attempts += 1.
+    Блокировки снимаются сразу после commit, запросы к панелям идут
+    вне транзакции. Пока аренда не истекла, строку не возьмёт никто,
+    даже если enqueue записал в неё новое событие и сдвинул next_try_at.
+    '''
+    ready = (
+        select(PanelQueue.id)
+        .where(
+            PanelQueue.next_try_at <= func.now(),
+            or_(PanelQueue.applied_version.is_(None), PanelQueue.version > PanelQueue.applied_version),
+            or_(PanelQueue.leased_until.is_(None), PanelQueue.leased_until < func.now()),
+        )
+        .order_by(PanelQueue.id)
+        .limit(settings.OUTBOX_BATCH)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(PanelQueue)
+        .where(PanelQueue.id.in_(ready))
+        .values(
+            leased_until=func.now() + timedelta(seconds=settings.OUTBOX_LEASE),
+            attempts=PanelQueue.attempts + 1,
+        )
+        .returning(*PanelQueue.__table__.c)
+        .execution_options(synchronize_session=False)
+    )
+    async with async_session() as session:
+        async with session.begin():
+            return list((await session.execute(stmt)).all())
+
+
+async def _apply(row) -> replication.PanelResult:
+    """Одна попытка; вместе с логином в панель - не дольше OUTBOX_CALL_TIMEOUT"""
+    panel = panels.get(row.panel)
+    if panel is None:
+        return replication.PanelResult(panel=row.panel, ok=False, error="panel not in registry")
+    try:
+        return await asyncio.wait_for(
+            replication.apply(panel, to_event(row), max_attempts=1),
+            timeout=settings.OUTBOX_CALL_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        return replication.PanelResult(panel=row.panel, ok=False, error=f"timeout {settings.OUTBOX_CALL_TIMEOUT}s")
+
+
+async def drain_once() -> int:
+    '''
+    Берёт пачку заданий в аренду (lease), применяет к панелям по одной
+    попытке вне транзакции, затем второй короткой транзакцией отмечает
+    успешные записанными (applied_version) и откладывает остальные
+    с backoff. Всё - только для своей
+    аренды и той же версии: строка, которую за время попытки перезаписало
+    новое событие, освобождается и ставится в очередь сразу.
+    Возвращает кол-во обработанных заданий.
+    '''
+    rows = await lease()
+    if not rows:
+        return 0
+
+    results = await asyncio.gather(*[_apply(row) for row in rows])
+
+    new_links: dict[str, dict[str, str]] = {}
+    done = []
+    async with async_session() as session:
+        async with session.begin():
+            for row, res in zip(rows, results):
+                if res.ok:
+                    done.append((row.id, row.leased_until, row.version))
+                    if res.sub_url:
+                        new_links.setdefault(row.username, {})[row.panel] = res.sub_url
+                    continue
+
+                await session.execute(
+                    update(PanelQueue)
+                    .where(
+                        PanelQueue.id == row.id,
+                        PanelQueue.leased_until == row.leased_until,
+                        PanelQueue.version == row.version,
+                    )
+                    .values(next_try_at=func.now() + backoff(row.attempts), leased_until=None, last_error=res.error)
+                    .execution_options(synchronize_session=False)
+                )
+                logger.warning(f'Outbox {row.action} {row.username} -> {row.panel}: попытка {row.attempts} ({res.error})')
+
+            if done:
+                await session.execute(
+                    update(PanelQueue)
+                    .where(tuple_(PanelQueue.id, PanelQueue.leased_until, PanelQueue.version).in_(done))
+                    .values(applied_version=PanelQueue.version, leased_until=None, last_error=None)
+                    .execution_options(synchronize_session=False)
+                )
+
+            # Остались в аренде - значит, версия сменилась: новое состояние сразу
+            await session.execute(
+                update(PanelQueue)
+                .where(tuple_(PanelQueue.id, PanelQueue.leased_until).in_([(row.id, row.leased_until) for row in rows]))
+                .values(leased_until=None, next_try_at=func.now())
+                .execution_options(synchronize_session=False)
+            )
+
+    await save_links(new_links)
+    logger.debug(f'Outbox: обработано {len(rows)}, успешно {len(done)}')
+    return len(rows)
+
+
+async def run_worker() -> None:
+    """Фоновая задача: разбирает outbox, пока есть готовые задания"""
+    logger.info('Outbox воркер запущен')
+    while True:
+        try:
+            if await drain_once():
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'Ошибка outbox воркера: {e}')
+        await asyncio.sleep(settings.OUTBOX_POLL_INTERVAL)
@@ -0,0 +1,39 @@
+from urllib.parse import urlsplit
+
+from config_data.config import settings, PanelConfig
+
+
+# Реестр панелей из настроек, порядок = приоритет
+PANELS: dict[str, PanelConfig] = {panel.name: panel for panel in settings.PANELS}
+
+# Панели, у которых есть колонка в links (старая схема)
+LEGACY_COLUMNS = ("panel_1", "panel_2")
+
+
+def get(name: str) -> PanelConfig | None:
+    return PANELS.get(name)
+
+
+def names() -> list[str]:
+    return list(PANELS)
+
+
+def for_url(url: str) -> PanelConfig | None:
+    '''
+    Определяет панель по subscription_url или адресу API.
+    Сначала по подстроке match, затем по совпадению хоста с url панели.
+    '''
+    for panel in PANELS.values():
+        if panel.match and panel.match in url:
+            return panel
+
+    host = urlsplit(url).hostname
+    for panel in PANELS.values():
+        if urlsplit(panel.url).hostname == host:
+            return panel
+    return None
+
+
+def others(name: str | None) -> list[PanelConfig]:
+    """Все панели, кроме указанной"""
+    return [panel for panel in PANELS.values() if panel.name != name]
@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy import select
+
+import app.redis_client as redis_module
+from config_data.config import settings, PanelConfig
+from db.database import async_session
+from db.db_models import LinksOrm, UserPanelLinkOrm
+from logger_setup import logger
+from marz import panels, replication
+from marz.backend import MarzbanClient, close_sessions
+from misc import routing
+from misc.utils import save_links
+
+
+# Полная сверка по расписанию делает один воркер за интервал
+RECONCILE_LOCK = "reconcile:panels"
+
+# Поля пользователя, нужные для сверки
+FIELDS = ("username", "expire", "proxies", "inbounds", "subscription_url")
+
+
+@dataclass(slots=True, frozen=True)
+class UserRecord:
+    uuid: str | None
+    expire: int | None
+    inbounds: tuple[str, ...]
+    sub_url: str | None
+
+    @property
+    def state(self) -> tuple:
+        """То, что должно совпадать на всех панелях"""
+        return (self.expire, self.inbounds)
+
+
+@dataclass(slots=True)
+class PanelReport:
+    total: int = 0
+    missing: list[str] = field(default_factory=list)
+    divergent: list[str] = field(default_factory=list)
+    conflicts: list[str] = field(default_factory=list)  # другой uuid - сами не чиним
+    repaired: int = 0
+    failed: int = 0
+
+
+@dataclass(slots=True)
+class Report:
+    dry_run: bool
+    panels: dict[str, PanelReport] = field(default_factory=dict)
+    users: int = 0
+    links_updated: int = 0
+    skipped: int = 0  # не уложились в RECONCILE_MAX_REPAIRS
+    elapsed: float = 0.0
+
+    def summary(self) -> str:
+        lines = [
+            f"Сверка панелей{' (dry-run)' if self.dry_run else ''}: "
+            f"{self.users} пользователей за {self.elapsed:.1f} сек"
+        ]
+        for name, r in self.panels.items():
+            lines.append(
+                f"{name}: всего {r.total}, нет {len(r.missing)}, расходятся {len(r.divergent)}, "
+                f"другой uuid {len(r.conflicts)}, исправлено {r.repaired}, ошибок {r.failed}"
+            )
+            if r.conflicts:
+                lines.append(f"  другой uuid: {', '.join(r.conflicts[:20])}")
+        lines.append(f"Ссылок обновлено: {self.links_updated}, отложено починок: {self.skipped}")
+        return "\n".join(lines)
+
+
+def _record(user: dict) -> UserRecord:
+    vless = (user.get("proxies") or {}).get("vless") or {}
+    inbounds = (user.get("inbounds") or {}).get("vless") or []
+    return UserRecord(
+        uuid=vless.get("id"),
+        expire=user.get("expire"),
+        inbounds=tuple(sorted(inbounds)),
+        sub_url=user.get("subscription_url"),
+    )
+
+
+async def snapshot(panel: PanelConfig) -> dict[str, UserRecord]:
+    """Все пользователи панели {username: UserRecord} постранично"""
+    client = MarzbanClient(panel.url)
+    users: dict[str, UserRecord] = {}
+    async for user in client.iter_users(fields=FIELDS):
+        users[str(user["username"])] = _record(user)
+    logger.info(f"Сверка: {panel.name} - {len(users)} пользователей")
+    return users
+
+
+def _expire_key(record: UserRecord) -> float:
+    # Пустой expire в Marzban - бессрочно
+    return float("inf") if not record.expire else record.expire
+
+
+def desired(snapshots: dict[str, dict[str, UserRecord]]) -> dict[str, UserRecord]:
+    '''
+    Эталон по каждому пользователю: запись с самым поздним expire
+    среди всех панелей (оплата/продление применились хотя бы там).
+    '''
+    best: dict[str, UserRecord] = {}
+    for users in snapshots.values():
+        for username, record in users.items():
+            current = best.get(username)
+            if current is None or _expire_key(record) > _expire_key(current):
+                best[username] = record
+    return best
+
+
+def diff(snapshots: dict[str, dict[str, UserRecord]], target: dict[str, UserRecord]) -> dict[str, PanelReport]:
+    """Расхождения каждой панели с эталоном: множества имён + сравнение состояний"""
+    everyone = target.keys()
+    reports = {}
+    for name, users in snapshots.items():
+        report = PanelReport(total=len(users))
+        report.missing = sorted(everyone - users.keys())
+        for username in everyone & users.keys():
+            record, want = users[username], target[username]
+            if want.uuid and record.uuid != want.uuid:
+                report.conflicts.append(username)
+            elif record.state != want.state:
+                report.divergent.append(username)
+        report.divergent.sort()
+        report.conflicts.sort()
+        reports[name] = report
+    return reports
+
+
+def _event(username: str, action: str, record: UserRecord) -> dict:
+    """Синтетическое событие Marzban для replication.apply"""
+    return {
+        "username": username,
+        "action": action,
+        "user": {
+            "proxies": {"vless": {"id": record.uuid}},
+            "inbounds": {"vless": list(record.inbounds)},
+            "expire": record.expire,
+        },
+    }
+
+
+async def _repair(
+    reports: dict[str, PanelReport],
+    target: dict[str, UserRecord],
+    budget: int,
+) -> tuple[dict[str, dict[str, str]], int]:
+    '''
+    Создаёт недостающих и доводит расходящихся пользователей через
+    replication.apply (идемпотентно, с лимитом запросов на панель).
+    Не больше budget операций за запуск.
+    Возвращает новые ссылки {username: {панель: ссылка}} и кол-во отложенных.
+    '''
+    jobs = []
+    for name, report in reports.items():
+        panel = panels.get(name)
+        for action, usernames in (("user_created", report.missing), ("user_updated", report.divergent)):
+            for username in usernames:
+                jobs.append((panel, report, username, _event(username, action, target[username])))
+
+    skipped = max(len(jobs) - budget, 0)
+    jobs = jobs[:budget]
+
+    async def run(panel, report, username, event):
+        res = await replication.apply(panel, event, max_attempts=2)
+        if res.ok:
+            report.repaired += 1
+        else:
+            report.failed += 1
+        return username, res
+
+    results = await asyncio.gather(*[run(*job) for job in jobs])
+
+    new_links: dict[str, dict[str, str]] = {}
+    for username, res in results:
+        if res.ok and res.sub_url:
+            new_links.setdefault(username, {})[res.panel] = res.sub_url
+    return new_links, skipped
+
+
+async def _stale_links(snapshots: dict[str, dict[str, UserRecord]]) -> dict[str, dict[str, str]]:
+    """Ссылки в links/user_panel_links, которые разошлись с панелями"""
+    async with async_session() as session:
+        links = (await session.execute(
+            select(LinksOrm.user_id, LinksOrm.panel_1, LinksOrm.panel_2)
+        )).all()
+        rows = (await session.execute(
+            select(UserPanelLinkOrm.user_id, UserPanelLinkOrm.panel, UserPanelLinkOrm.sub_url)
+        )).all()
+
+    by_user: dict[str, list] = {}
+    for row in rows:
+        by_user.setdefault(row.user_id, []).append(row)
+
+    stale: dict[str, dict[str, str]] = {}
+    for link in links:
+        known = routing.merge_links(link, by_user.get(link.user_id, []))
+        for name, users in snapshots.items():
+            record = users.get(link.user_id)
+            if record is not None and record.sub_url and known.get(name) != record.sub_url:
+                stale.setdefault(link.user_id, {})[name] = record.sub_url
+    return stale
+
+
+async def reconcile(dry_run: bool = False, max_repairs: int | None = None) -> Report:
+    '''
+    Полная сверка панелей реестра:
+    1. параллельно выгружает пользователей всех панелей (iter_users);
+    2. считает эталон и расхождения по username, uuid, expire, inbounds;
+    3. без dry_run чинит не больше max_repairs пользователей
+       и одной пачкой обновляет ссылки в links/user_panel_links.
+    '''
+    started = time.monotonic()
+    report = Report(dry_run=dry_run)
+
+    names = panels.names()
+    results = await asyncio.gather(*[snapshot(panels.get(name)) for name in names]) #type: ignore
+    snapshots = dict(zip(names, results))
+
+    target = desired(snapshots)
+    report.users = len(target)
+    report.panels = diff(snapshots, target)
+
+    new_links = await _stale_links(snapshots)
+    if not dry_run:
+        budget = settings.RECONCILE_MAX_REPAIRS if max_repairs is None else max_repairs
+        repaired_links, report.skipped = await _repair(report.panels, target, budget)
+        for username, links in repaired_links.items():
+            new_links.setdefault(username, {}).update(links)
+
+        usernames = list(new_links)
+        for i in range(0, len(usernames), settings.MARZ_USERS_PAGE):
+            await save_links({username: new_links[username] for username in usernames[i:i + settings.MARZ_USERS_PAGE]})
+    report.links_updated = sum(len(links) for links in new_links.values())
+
+    report.elapsed = time.monotonic() - started
+    logger.info(report.summary())
+    return report
+
+
+async def run_scheduled() -> None:
+    """Фоновая задача: сверка раз в RECONCILE_INTERVAL, один воркер за интервал"""
+    if not settings.RECONCILE_INTERVAL:
+        return
+    while True:
+        await asyncio.sleep(settings.RECONCILE_INTERVAL)
+        try:
+            redis = redis_module.redis_client
+            if redis is not None and not await redis.set(
+                RECONCILE_LOCK, "1", nx=True, ex=max(int(settings.RECONCILE_INTERVAL) - 1, 1)
+            ):
+                continue
+            await reconcile()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка сверки панелей: {e}")
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description="Сверка пользователей между панелями Marzban")
+    parser.add_argument("--dry-run", action="store_true", help="только отчёт, без изменений")
+    parser.add_argument("--max-repairs", type=int, default=None, help="не больше N починок за запуск")
+    args = parser.parse_args()
+
+    redis_module.redis_client = await redis_module.init_redis()
+    try:
+        report = await reconcile(dry_run=args.dry_run, max_repairs=args.max_repairs)
+        print(report.summary())
+    finally:
+        await close_sessions()
+        await redis_module.close_redis()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,111 @@
+import asyncio
+from dataclasses import dataclass
+
+from config_data.config import settings, PanelConfig
+from logger_setup import logger
+from marz import panels
+from marz.backend import MarzbanClient
+
+
+# События Marzban, которые переносим на остальные панели
+REPLICATED_ACTIONS = ("user_created", "user_updated")
+
+
+@dataclass(slots=True)
+class PanelResult:
+    panel: str
+    ok: bool
+    sub_url: str | None = None
+    error: str | None = None
+
+
+# Ограничение одновременных запросов к каждой панели
+_limits: dict[str, asyncio.Semaphore] = {}
+
+
+def _limit(panel: str) -> asyncio.Semaphore:
+    sem = _limits.get(panel)
+    if sem is None:
+        sem = _limits[panel] = asyncio.Semaphore(settings.REPLICATION_PER_PANEL)
+    return sem
+
+
+def source_panel(event: dict) -> str | None:
+    '''
+    Определяет по subscription_url из события, с какой панели оно пришло.
+    Возвращает имя панели из реестра или None.
+    '''
+    pan = event["user"]["subscription_url"]
+    logger.debug(f'Пришёл запрос от Marzban с панели: {pan[:15]}')
+
+    panel = panels.for_url(pan)
+    if panel is None:
+        logger.warning(f'Панель для {pan[:30]} не найдена в реестре')
+        return None
+    return panel.name
+
+
+def _in_sync(current: dict, user: dict) -> bool:
+    """На панели уже то же состояние, что несёт событие"""
+    return (
+        current.get("expire") == user["expire"]
+        and sorted((current.get("inbounds") or {}).get("vless") or []) == sorted(user["inbounds"]["vless"])
+    )
+
+
+async def _create(client: MarzbanClient, event: dict) -> dict | None:
+    user = event["user"]
+    res = await client.create_user_options(
+        username=event["username"],
+        id=user["proxies"]["vless"]["id"],
+        inbounds=user["inbounds"]["vless"],
+        expire=user["expire"],
+    )
+    if res is None:
+        # 409 и прочие отказы: если пользователь уже есть - доводим expire
+        current = await client.get_user(user_id=event["username"])
+        if current is None or _in_sync(current, user):
+            return current
+        res = await client.modify_user(user_id=event["username"], expire=user["expire"])
+    return res
+
+
+async def _update(client: MarzbanClient, event: dict) -> dict | None:
+    '''
+    PUT только если состояние на панели отличается: иначе панель
+    пришлёт свой user_updated, и событие будет гулять между панелями.
+    '''
+    user = event["user"]
+    current = await client.get_user(user_id=event["username"])
+    if current is None:
+        # Пользователь так и не был создан на этой панели - создаём
+        return await _create(client, event)
+    if _in_sync(current, user):
+        logger.debug(f'{event["username"]} на панели уже в актуальном состоянии')
+        return current
+    return await client.modify_user(
+        user_id=event["username"],
+        expire=user["expire"],
+        inbounds=list(user["inbounds"]["vless"]),
+    )
+
+
+async def apply(panel: PanelConfig, event: dict, max_attempts: int = 5) -> PanelResult:
+    '''
+    Применить одно событие к одной панели.
+    Операции идемпотентны: create для существующего пользователя
+    обновляет expire, update для отсутствующего - создаёт его.
+    '''
+    client = MarzbanClient(panel.url, max_attempts=max_attempts)
+    operation = _create if event["action"] == "user_created" else _update
+    try:
+        async with _limit(panel.name):
+            res = await operation(client, event)
+    except Exception as e:
+        logger.error(f'{event["action"]} {event["username"]} на {panel.name}: {e}')
+        return PanelResult(panel=panel.name, ok=False, error=str(e)[:200])
+
+    if res is None:
+        return PanelResult(panel=panel.name, ok=False, error="panel returned no data")
+    return PanelResult(panel=panel.name, ok=True, sub_url=res.get("subscription_url"))
+
@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import os
+import socket
+
+import orjson
+
+from redis.exceptions import ResponseError
+
+import app.redis_client as redis_module
+from config_data.config import settings
+from logger_setup import logger
+from marz.events import process_batch
+from misc import versions
+
+
+# Имя консумера в группе: уникально для процесса (воркер Granian / хост)
+CONSUMER = f"{socket.gethostname()}-{os.getpid()}"
+
+
+async def append(events: list[dict]) -> list[str]:
+    '''
+    Дописывает сырые события Marzban в стрим одним pipeline.
+    Стрим обрезается примерно до MARZ_STREAM_MAXLEN записей.
+    Возвращает id записей.
+    '''
+    if not events:
+        return []
+    redis = redis_module.redis_client
+    async with redis.pipeline(transaction=False) as pipe: #type: ignore
+        for event in events:
+            pipe.xadd(
+                settings.MARZ_STREAM,
+                {"event": orjson.dumps(event).decode()},
+                maxlen=settings.MARZ_STREAM_MAXLEN,
+                approximate=True,
+            )
+        return await pipe.execute()
+
+
+async def ensure_group() -> None:
+    """Создаёт стрим и группу консумеров, если их ещё нет"""
+    try:
+        await redis_module.redis_client.xgroup_create( #type: ignore
+            settings.MARZ_STREAM, settings.MARZ_STREAM_GROUP, id="0", mkstream=True
+        )
+        logger.info(f'Группа {settings.MARZ_STREAM_GROUP} для {settings.MARZ_STREAM} создана')
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _decode(entries) -> tuple[list[str], list[dict]]:
+    ids, events = [], []
+    for entry_id, fields in entries:
+        ids.append(entry_id)
+        if not fields:
+            # Запись удалена из стрима (XTRIM), остался только pending
+            continue
+        try:
+            event = orjson.loads(fields["event"])
+        except (KeyError, orjson.JSONDecodeError) as e:
+            logger.error(f'Битая запись {entry_id} в {settings.MARZ_STREAM}: {e}')
+            continue
+        # id записи задаёт порядок событий между консумерами
+        event[versions.EVENT_FIELD] = versions.from_stream_id(entry_id)
+        events.append(event)
+    return ids, events
+
+
+async def _handle(entries, dedupe: bool) -> int:
+    '''
+    Обрабатывает записи и подтверждает их (XACK).
+    При ошибке записи остаются в pending и будут забраны reclaim.
+    '''
+    if not entries:
+        return 0
+    ids, events = _decode(entries)
+    if events:
+        stats = await process_batch(events, dedupe=dedupe)
+        logger.debug(f'Стрим Marzban: {stats}')
+    await redis_module.redis_client.xack(settings.MARZ_STREAM, settings.MARZ_STREAM_GROUP, *ids) #type: ignore
+    return len(ids)
+
+
+async def reclaim() -> int:
+    '''
+    Забирает записи, которые другой консумер прочитал, но не подтвердил
+    дольше MARZ_STREAM_CLAIM_IDLE_MS (упавший воркер), и обрабатывает их.
+    '''
+    redis = redis_module.redis_client
+    handled = 0
+    start = "0-0"
+    while True:
+        res = await redis.xautoclaim( #type: ignore
+            settings.MARZ_STREAM,
+            settings.MARZ_STREAM_GROUP,
+            CONSUMER,
+            min_idle_time=settings.MARZ_STREAM_CLAIM_IDLE_MS,
+            start_id=start,
+            count=settings.MARZ_STREAM_BATCH,
+        )
+        start, entries = res[0], res[1]
+        if entries:
+            logger.warning(f'Забрано {len(entries)} неподтверждённых событий Marzban')
+        # Первая попытка уже выставила ключи дублей - не отбрасываем
+        handled += await _handle(entries, dedupe=False)
+        if start == "0-0":
+            return handled
+
+
+async def run_consumer() -> None:
+    """Фоновая задача: читает стрим в составе группы консумеров"""
+    redis = redis_module.redis_client
+    claim_every = settings.MARZ_STREAM_CLAIM_IDLE_MS / 1000
+    last_claim = 0.0
+    loop = asyncio.get_running_loop()
+    ready = False
+
+    while True:
+        try:
+            # Группа создаётся здесь же: сбой Redis на старте повторяется, как и прочие
+            if not ready:
+                await ensure_group()
+                ready = True
+                logger.info(f'Консумер {CONSUMER} стрима {settings.MARZ_STREAM} запущен')
+
+            if loop.time() - last_claim >= claim_every:
+                last_claim = loop.time()
+                await reclaim()
+
+            res = await redis.xreadgroup( #type: ignore
+                settings.MARZ_STREAM_GROUP,
+                CONSUMER,
+                streams={settings.MARZ_STREAM: ">"},
+                count=settings.MARZ_STREAM_BATCH,
+                block=settings.MARZ_STREAM_BLOCK_MS,
+            )
+            for _, entries in res or []:
+                await _handle(entries, dedupe=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'Ошибка консумера стрима Marzban: {e}')
+            await asyncio.sleep(1)
+
+
+async def replay(start: str = "-", end: str = "+", dry_run: bool = False) -> int:
+    '''
+    Повторно обрабатывает записи стрима из диапазона id [start, end]
+    в обход группы (без XACK) - для досыпки данных после сбоев.
+    '''
+    redis = redis_module.redis_client
+    total = 0
+    while True:
+        entries = await redis.xrange(settings.MARZ_STREAM, min=start, max=end, count=settings.MARZ_STREAM_BATCH) #type: ignore
+        if not entries:
+            return total
+        _, events = _decode(entries)
+        if not dry_run and events:
+            await process_batch(events, dedupe=False)
+        total += len(entries)
+        logger.info(f'Replay: {total} записей, последняя {entries[-1][0]}')
+        # Следующая страница - строго после последнего id
+        start = f"({entries[-1][0]}"
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description="Лог событий Marzban в Redis Stream")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rp = sub.add_parser("replay", help="повторно обработать события из стрима")
+    rp.add_argument("--from", dest="start", default="-", help="id записи или ms-время, по умолчанию с начала")
+    rp.add_argument("--to", dest="end", default="+", help="id записи или ms-время, по умолчанию до конца")
+    rp.add_argument("--dry-run", action="store_true", help="только посчитать записи")
+
+    sub.add_parser("info", help="длина стрима и состояние группы")
+
+    args = parser.parse_args()
+    redis_module.redis_client = await redis_module.init_redis()
+    try:
+        if args.command == "replay":
+            total = await replay(start=args.start, end=args.end, dry_run=args.dry_run)
+            print(f"Обработано записей: {total}")
+        else:
+            redis = redis_module.redis_client
+            print(f"Длина: {await redis.xlen(settings.MARZ_STREAM)}")
+            for group in await redis.xinfo_groups(settings.MARZ_STREAM):
+                print(group)
+    finally:
+        await redis_module.close_redis()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
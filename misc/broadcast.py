@@ -0,0 +1,47 @@
+import asyncio
+from typing import Awaitable, Callable
+
+import app.redis_client as redis_module
+from logger_setup import logger
+
+
+# Обработчики сообщений Redis pub/sub по каналам
+Handler = Callable[[str], Awaitable[None]]
+_handlers: dict[str, list[Handler]] = {}
+
+
+def subscribe(channel: str, handler: Handler) -> None:
+    """Зарегистрировать обработчик канала (до запуска listen)"""
+    _handlers.setdefault(channel, []).append(handler)
+
+
+async def publish(channel: str, message: str) -> None:
+    """Разослать сообщение всем воркерам, включая текущий"""
+    if redis_module.redis_client is None:
+        logger.warning(f"Redis не подключён, сообщение в {channel} не отправлено")
+        return
+    await redis_module.redis_client.publish(channel, message)
+
+
+async def listen() -> None:
+    """Фоновая задача: слушает все зарегистрированные каналы"""
+    while True:
+        pubsub = redis_module.redis_client.pubsub(ignore_subscribe_messages=True) #type: ignore
+        try:
+            await pubsub.subscribe(*_handlers)
+            logger.info(f"Подписка на каналы {list(_handlers)}")
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                for handler in _handlers.get(message["channel"], []):
+                    try:
+                        await handler(message["data"])
+                    except Exception as e:
+                        logger.error(f"Ошибка обработчика {message['channel']}: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Pub/sub соединение потеряно: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
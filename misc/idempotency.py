@@ -0,0 +1,90 @@
+from dataclasses import dataclass
+from typing import Any
+
+import orjson
+
+import app.redis_client as redis_module
+from logger_setup import logger
+
+
+# Сколько секунд помним доставку по типу события.
+# Тип "marzban:<action>" без своей записи берёт TTL "marzban".
+TTL = {
+    "update": 3600,        # Telegram повторяет апдейт, пока не получит 2xx
+    "callback": 60,        # callback_id живёт недолго
+    "pay": 7 * 86400,      # YooKassa повторяет уведомление до суток и дольше
+    "marzban": 60,
+    "marzban:reached_days_left": 3600,
+    "marzban:user_expired": 300,
+}
+
+# Значение ключа, пока первая доставка не сохранила результат
+PENDING = "1"
+
+
+@dataclass(slots=True)
+class Claim:
+    first: bool                # эта доставка первая - обрабатываем
+    result: Any | None = None  # сохранённый ответ первой доставки (если был)
+
+
+def ttl_for(kind: str) -> int:
+    if kind in TTL:
+        return TTL[kind]
+    return TTL[kind.split(":", 1)[0]]
+
+
+def _key(kind: str, key: str | int) -> str:
+    return f"idem:{kind}:{key}"
+
+
+def _claim(old: str | None) -> Claim:
+    if old is None:
+        return Claim(first=True)
+    if old == PENDING:
+        return Claim(first=False)
+    return Claim(first=False, result=orjson.loads(old))
+
+
+async def claim(kind: str, key: str | int) -> Claim:
+    '''
+    Атомарно занимает ключ доставки одним запросом: SET NX GET.
+    Вернул first=False - это повтор, result - ответ первой доставки.
+    Без Redis считаем каждую доставку первой.
+    '''
+    redis = redis_module.redis_client
+    if redis is None:
+        return Claim(first=True)
+    old = await redis.set(_key(kind, key), PENDING, nx=True, get=True, ex=ttl_for(kind))
+    return _claim(old)
+
+
+async def claim_many(items: list[tuple[str, str | int]]) -> list[Claim]:
+    """claim для пачки (kind, key) одним pipeline"""
+    redis = redis_module.redis_client
+    if redis is None or not items:
+        return [Claim(first=True) for _ in items]
+    async with redis.pipeline(transaction=False) as pipe:
+        for kind, key in items:
+            pipe.set(_key(kind, key), PENDING, nx=True, get=True, ex=ttl_for(kind))
+        olds = await pipe.execute()
+    return [_claim(old) for old in olds]
+
+
+async def remember(kind: str, key: str | int, result: Any) -> None:
+    """Сохранить ответ первой доставки для повторов (TTL ключа не меняется)"""
+    redis = redis_module.redis_client
+    if redis is None:
+        return
+    await redis.set(_key(kind, key), orjson.dumps(result).decode(), xx=True, keepttl=True)
+
+
+async def release(kind: str, key: str | int) -> None:
+    """Освободить ключ, если обработка не удалась и повтор должен пройти"""
+    redis = redis_module.redis_client
+    if redis is None:
+        return
+    try:
+        await redis.delete(_key(kind, key))
+    except Exception as e:
+        logger.warning(f"Не удалось освободить ключ {kind}:{key}: {e}")
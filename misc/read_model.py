@@ -0,0 +1,199 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+from urllib.parse import unquote, urlsplit
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+import app.redis_client as redis_module
+from config_data.config import settings
+from db.database import async_session
+from db.db_models import SubscriptionStateOrm, UserOrm
+from logger_setup import logger
+from marz import panels
+from marz.backend import MarzbanClient
+from misc import versions
+from repositories.base import BaseRepository
+
+
+# Сверку с панелью делает один воркер за интервал
+SWEEP_LOCK = "read_model:sweep"
+
+
+@dataclass(slots=True)
+class LinksSub:
+    sub_link: str
+    links: list
+    titles: list
+    expire: int | None = None
+    status: str | None = None
+    stale: bool = False  # последнее хорошее значение, панель не подтвердила
+    version: int = 0     # misc.versions; 0 - версия по времени записи
+
+
+def project(user: dict) -> LinksSub | None:
+    '''
+    Компактная проекция пользователя Marzban: только то, что нужно меню.
+    Названия ссылок (после #) раскодируются один раз здесь.
+    '''
+    links = user.get("links")
+    sub_link = user.get("subscription_url")
+    if links is None or sub_link is None:
+        return None
+
+    titles = []
+    for link in links:
+        sta = link.find("#")
+        titles.append(unquote(link[sta+1:]))
+    return LinksSub(
+        sub_link=sub_link,
+        links=links,
+        titles=titles,
+        expire=user.get("expire"),
+        status=user.get("status"),
+    )
+
+
+def is_primary(sub_url: str) -> bool:
+    """Ссылка с основной панели (M_DIGITAL_URL), с которой читает бот"""
+    primary = panels.for_url(settings.M_DIGITAL_URL)
+    if primary is not None:
+        panel = panels.for_url(sub_url)
+        return panel is not None and panel.name == primary.name
+    return urlsplit(sub_url).hostname == urlsplit(settings.M_DIGITAL_URL).hostname
+
+
+def from_events(events: list[dict]) -> dict[str, LinksSub]:
+    """Последнее состояние каждого пользователя основной панели из пачки событий"""
+    states: dict[str, LinksSub] = {}
+    for event in events:
+        user = event.get("user")
+        if not user or not user.get("subscription_url") or not is_primary(user["subscription_url"]):
+            continue
+        sub = project(user)
+        if sub is not None:
+            sub.version = event[versions.EVENT_FIELD]
+            states[str(event["username"])] = sub
+    return states
+
+
+def _row(user_id: str, sub: LinksSub) -> dict:
+    return {
+        "user_id": user_id,
+        "status": sub.status,
+        "expire": sub.expire,
+        "sub_link": sub.sub_link,
+        "links": sub.links,
+        "titles": sub.titles,
+        "version": sub.version or versions.now(),
+    }
+
+
+async def get(user_id: str) -> LinksSub | None:
+    async with async_session() as session:
+        row = await BaseRepository(session=session, model=SubscriptionStateOrm).get_by_id(str(user_id))
+    if row is None or row.sub_link is None:
+        return None
+    return LinksSub(
+        sub_link=row.sub_link,
+        links=list(row.links),
+        titles=list(row.titles),
+        expire=row.expire,
+        status=row.status,
+    )
+
+
+async def save(states: dict[str, LinksSub]) -> None:
+    '''
+    Записывает состояния одной транзакцией: upsert в subscription_state
+    и users.subscription_end для тех, кто есть в users.
+    Состояние старше записанного (version) строку не меняет, а
+    subscription_end берётся из того, что осталось в таблице.
+    '''
+    if not states:
+        return
+    async with async_session() as session:
+        repo = BaseRepository(session=session, model=SubscriptionStateOrm)
+        users_repo = BaseRepository(session=session, model=UserOrm)
+
+        await repo.upsert_many(
+            [_row(user_id, sub) for user_id, sub in states.items()],
+            index_elements=["user_id"],
+            update_fields=["status", "expire", "sub_link", "links", "titles", "version"],
+            set_={"updated_at": func.now()},
+            where=SubscriptionStateOrm.version <= insert(SubscriptionStateOrm).excluded.version,
+            commit=False,
+        )
+        stored = await repo.list(user_id__in=list(states))
+        known = {user.user_id for user in await users_repo.list(user_id__in=list(states))}
+        await users_repo.bulk_update([
+            {
+                "user_id": row.user_id,
+                "subscription_end": datetime.fromtimestamp(row.expire) if row.expire else None,
+            }
+            for row in stored if row.user_id in known
+        ], commit=False)
+        await session.commit()
+
+
+async def _sweep_chunk(fresh: dict[str, LinksSub]) -> int:
+    """Сверить и записать одну пачку пользователей панели"""
+    # Импорт здесь: user_cache сам зависит от read_model
+    from misc import user_cache
+
+    async with async_session() as session:
+        rows = await BaseRepository(session=session, model=SubscriptionStateOrm).list(user_id__in=list(fresh))
+    current = {row.user_id: (row.status, row.expire, row.sub_link, list(row.links)) for row in rows}
+
+    changed = {
+        user_id: sub for user_id, sub in fresh.items()
+        if current.get(user_id) != (sub.status, sub.expire, sub.sub_link, sub.links)
+    }
+    await save(changed)
+    await user_cache.invalidate(*changed)
+    return len(changed)
+
+
+async def sweep() -> int:
+    '''
+    Сверка с основной панелью: постранично перечитывает всех пользователей
+    и записывает тех, чьё состояние разошлось с локальным.
+    Возвращает кол-во исправленных.
+    '''
+    client = MarzbanClient(settings.M_DIGITAL_URL)
+    total = fixed = 0
+    chunk: dict[str, LinksSub] = {}
+
+    async for user in client.iter_users():
+        total += 1
+        sub = project(user)
+        if sub is not None:
+            # Версия - момент чтения: вебхук, пришедший позже, сверка не затрёт
+            sub.version = versions.now()
+            chunk[str(user["username"])] = sub
+        if len(chunk) >= settings.MARZ_USERS_PAGE:
+            fixed += await _sweep_chunk(chunk)
+            chunk = {}
+    if chunk:
+        fixed += await _sweep_chunk(chunk)
+
+    logger.info(f'Сверка подписок: {total} пользователей, исправлено {fixed}')
+    return fixed
+
+
+async def run_sweep() -> None:
+    """Фоновая задача: периодическая сверка, один воркер за интервал"""
+    while True:
+        await asyncio.sleep(settings.READ_MODEL_SWEEP_INTERVAL)
+        try:
+            redis = redis_module.redis_client
+            if redis is not None and not await redis.set(
+                SWEEP_LOCK, "1", nx=True, ex=max(int(settings.READ_MODEL_SWEEP_INTERVAL) - 1, 1)
+            ):
+                continue
+            await sweep()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'Ошибка сверки подписок: {e}')
@@ -0,0 +1,167 @@
+import asyncio
+import json
+
+from sqlalchemy import select
+
+import app.redis_client as redis_module
+from config_data.config import settings
+from db.database import async_session
+from db.db_models import LinksOrm, UserPanelLinkOrm
+from logger_setup import logger
+from marz import panels
+from misc import broadcast
+from misc.bloom import BloomFilter
+
+
+LINKS_CHANNEL = "links:updated"
+# Все uuid из links - общее для воркеров множество в Redis. Пополняется
+# при записи ссылок, целиком дописывается одним воркером за LINKS_RESYNC_INTERVAL
+KNOWN_KEY = "links:uuids"
+KNOWN_SYNC_LOCK = "links:uuids:sync"
+
+# uuid -> ((панель, ссылка), ...): таблица маршрутизации /sub в памяти воркера
+_routes: dict[str, tuple[tuple[str, str], ...]] = {}
+
+# Все известные uuid из links: отсекает случайные/удалённые uuid без БД.
+# None - фильтр ещё не построен, пропускаем всё.
+_known: BloomFilter | None = None
+
+
+def merge_links(link, rows) -> dict[str, str]:
+    '''
+    Собирает ссылки пользователя {панель: ссылка} в порядке реестра.
+    Колонки panel_1/panel_2 из links учитываются, пока по панели
+    нет строки в user_panel_links.
+    '''
+    found: dict[str, str] = {}
+    if link is not None:
+        for column in panels.LEGACY_COLUMNS:
+            value = getattr(link, column)
+            if value:
+                found[column] = value
+    for row in rows:
+        found[row.panel] = row.sub_url
+
+    ordered = {name: found.pop(name) for name in panels.names() if name in found}
+    ordered.update(found)
+    return ordered
+
+
+def lookup(uuid: str) -> dict | None:
+    """Ссылки панелей для uuid без обращения к БД"""
+    route = _routes.get(uuid)
+    if route is None:
+        return None
+    return dict(route)
+
+
+async def may_exist(uuid: str) -> bool:
+    '''
+    False - такого uuid в links точно нет.
+    Фильтр воркера мог пропустить обновление (потерянное сообщение
+    pub/sub, запись во время load), поэтому его "нет" перепроверяется
+    по общему множеству в Redis. Без Redis - идём в БД.
+    '''
+    if _known is None or uuid in _known:
+        return True
+    redis = redis_module.redis_client
+    if redis is None:
+        return True
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.sismember(KNOWN_KEY, uuid)
+            pipe.exists(KNOWN_KEY)
+            found, filled = await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Не удалось проверить uuid в Redis: {e}")
+        return True
+    if found:
+        put_known(uuid)
+    # Множества нет (Redis перезапущен, ещё не заполнено) - ответу не верим
+    return bool(found) or not filled
+
+
+def put_known(uuid: str) -> None:
+    if _known is not None:
+        _known.add(uuid)
+
+
+def put(uuid: str, links: dict[str, str]) -> None:
+    _routes[uuid] = tuple(links.items())
+    put_known(uuid)
+
+
+async def _share_known(uuids: list[str]) -> None:
+    """Дописать uuid в общее множество; полный список - один воркер за интервал"""
+    redis = redis_module.redis_client
+    if redis is None or not uuids:
+        return
+    if not await redis.set(KNOWN_SYNC_LOCK, "1", nx=True, ex=max(int(settings.LINKS_RESYNC_INTERVAL) - 1, 1)):
+        return
+    for i in range(0, len(uuids), 1000):
+        await redis.sadd(KNOWN_KEY, *uuids[i:i + 1000]) #type: ignore
+
+
+async def load() -> int:
+    """Полная загрузка таблицы и bloom-фильтра из links (старт и периодическая сверка)"""
+    global _known
+    async with async_session() as session:
+        links = (await session.execute(
+            select(LinksOrm.user_id, LinksOrm.uuid, LinksOrm.panel_1, LinksOrm.panel_2)
+        )).all()
+        rows = (await session.execute(
+            select(UserPanelLinkOrm.user_id, UserPanelLinkOrm.panel, UserPanelLinkOrm.sub_url)
+        )).all()
+
+    by_user: dict[str, list] = {}
+    for row in rows:
+        by_user.setdefault(row.user_id, []).append(row)
+
+    fresh = {
+        link.uuid: tuple(merge_links(link, by_user.get(link.user_id, [])).items())
+        for link in links
+    }
+
+    # Запас по ёмкости, чтобы новые uuid до следующей сверки не портили точность
+    known = BloomFilter(capacity=max(len(fresh) * 2, 10_000), error_rate=settings.LINKS_BLOOM_ERROR_RATE)
+    for uuid in fresh:
+        known.add(uuid)
+
+    _routes.clear()
+    _routes.update(fresh)
+    _known = known
+    logger.info(f"Таблица маршрутов загружена: {len(_routes)} uuid")
+
+    try:
+        await _share_known(list(fresh))
+    except Exception as e:
+        logger.warning(f"Не удалось записать uuid в Redis: {e}")
+    return len(_routes)
+
+
+async def publish(uuid: str, links: dict[str, str]) -> None:
+    """Обновить маршрут у себя и разослать остальным воркерам"""
+    put(uuid, links)
+    if redis_module.redis_client is not None:
+        await redis_module.redis_client.sadd(KNOWN_KEY, uuid) #type: ignore
+    await broadcast.publish(LINKS_CHANNEL, json.dumps({"uuid": uuid, "links": links}))
+
+
+async def _on_update(message: str) -> None:
+    data = json.loads(message)
+    put(data["uuid"], data["links"])
+
+
+async def run_resync() -> None:
+    """Фоновая задача: перезагружает таблицу на случай потерянных сообщений"""
+    while True:
+        await asyncio.sleep(settings.LINKS_RESYNC_INTERVAL)
+        try:
+            await load()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Не удалось перезагрузить таблицу маршрутов: {e}")
+
+
+broadcast.subscribe(LINKS_CHANNEL, _on_update)
@@ -0,0 +1,185 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import re
+import time
+from dataclasses import dataclass, asdict
+from email.utils import formatdate, parsedate_to_datetime
+
+import aiohttp
+
+import app.redis_client as redis_module
+from config_data.config import settings
+from logger_setup import logger
+from marz import health
+from marz.backend import get_session
+
+
+CACHE_PREFIX = "sub:merged:"
+CACHE_KEEP = 24 * 3600  # сколько хранить прошлую версию ради ETag/304
+
+# Заголовки панели, которые клиенты читают из ответа подписки
+PASS_HEADERS = (
+    "subscription-userinfo",
+    "profile-update-interval",
+    "profile-title",
+    "support-url",
+    "profile-web-page-url",
+)
+
+
+# Формат подписки Marzban выбирает по User-Agent клиента (как в самой панели).
+# Склеивать умеем только списки ссылок (base64/текст), остальное - редирект
+CLIENT_FORMATS = (
+    ("clash-meta", re.compile(r"^([Cc]lash-verge|[Cc]lash[-\.]?[Mm]eta|[Ff][Ll][Cc]lash|[Mm]ihomo)")),
+    ("clash", re.compile(r"^([Cc]lash|[Ss]tash)")),
+    ("sing-box", re.compile(r"^(SFA|SFI|SFM|SFT|[Kk]aring|[Hh]iddify[Nn]ext)")),
+    ("outline", re.compile(r"^(SS|SSR|SSD|SSS|Outline|Shadowsocks|SSconf)")),
+)
+MERGEABLE = "links"
+
+
+def client_format(user_agent: str | None) -> str:
+    for name, pattern in CLIENT_FORMATS:
+        if user_agent and pattern.match(user_agent):
+            return name
+    return MERGEABLE
+
+
+def mergeable(user_agent: str | None) -> bool:
+    """Клиенту панель отдаст список ссылок - его можно склеить"""
+    return client_format(user_agent) == MERGEABLE
+
+
+@dataclass(slots=True)
+class MergedSub:
+    body: str
+    etag: str
+    last_modified: str    # HTTP-date
+    fetched_at: float
+    headers: dict[str, str]
+
+
+# Сборка подписки на uuid (и формат), которая уже идёт в этом воркере
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def _lines(body: str) -> list[str] | None:
+    """Ссылки из тела подписки: base64 или обычный текст. None - формат не тот"""
+    text = body.strip()
+    try:
+        text = base64.b64decode(text + "=" * (-len(text) % 4), validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        pass
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or not all("://" in line for line in lines):
+        return None
+    return lines
+
+
+def merge(bodies: list[str]) -> str | None:
+    """Объединяет ссылки всех панелей без повторов, порядок панелей сохраняется"""
+    merged: dict[str, None] = {}
+    for body in bodies:
+        lines = _lines(body)
+        if lines is None:
+            logger.warning("Подписка панели не в base64/текстовом формате, пропущена")
+            continue
+        merged.update(dict.fromkeys(lines))
+    if not merged:
+        return None
+    return base64.b64encode("\n".join(merged).encode()).decode()
+
+
+async def _fetch(link: str, user_agent: str | None) -> tuple[str, dict[str, str]] | None:
+    timeout = aiohttp.ClientTimeout(total=settings.SUB_FETCH_TIMEOUT)
+    request_headers = {"User-Agent": user_agent} if user_agent else None
+    try:
+        async with get_session(link).get(link, timeout=timeout, headers=request_headers) as response:
+            if response.status != 200:
+                logger.warning(f"Подписка {link}: статус {response.status}")
+                return None
+            headers = {k: response.headers[k] for k in PASS_HEADERS if k in response.headers}
+            return await response.text(), headers
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Подписка {link} недоступна: {e}")
+        return None
+
+
+def _cache_key(uuid: str, user_agent: str | None) -> str:
+    return f"{CACHE_PREFIX}{client_format(user_agent)}:{uuid}"
+
+
+async def _build(uuid: str, links: dict[str, str | None], prev: MergedSub | None, user_agent: str | None) -> MergedSub | None:
+    # Панели, которые монитор видит упавшими, не ждём (если упали не все)
+    available = [link for link in links.values() if link]
+    alive = [
+        link for name, link in links.items()
+        if link and getattr(health.get_state(name), "up", True)
+    ]
+    targets = alive or available
+
+    results = [r for r in await asyncio.gather(*[_fetch(link, user_agent) for link in targets]) if r]
+    if not results:
+        return None
+
+    body = merge([text for text, _ in results])
+    if body is None:
+        return None
+
+    headers: dict[str, str] = {}
+    for _, panel_headers in reversed(results):
+        headers.update(panel_headers)
+
+    etag = f'"{hashlib.sha1(body.encode()).hexdigest()}"'
+    last_modified = prev.last_modified if prev and prev.etag == etag else formatdate(usegmt=True)
+    sub = MergedSub(body=body, etag=etag, last_modified=last_modified, fetched_at=time.time(), headers=headers)
+
+    if redis_module.redis_client is not None:
+        await redis_module.redis_client.set(_cache_key(uuid, user_agent), json.dumps(asdict(sub)), ex=CACHE_KEEP)
+    logger.debug(f"Подписка {uuid} собрана из {len(results)} панелей")
+    return sub
+
+
+async def get_merged(uuid: str, links: dict[str, str | None], user_agent: str | None = None) -> MergedSub | None:
+    '''
+    Объединённая подписка из всех панелей пользователя.
+    User-Agent клиента передаётся панелям, формат входит в ключ кэша.
+    Хранится в Redis: пока моложе SUB_CACHE_TTL - отдаётся как есть,
+    иначе пересобирается (одна сборка на uuid и формат в воркере).
+    Если панели не ответили - отдаётся прошлая версия.
+    None - собрать нечего (панели недоступны или ответили не списком ссылок).
+    '''
+    key = _cache_key(uuid, user_agent)
+    prev = None
+    if redis_module.redis_client is not None:
+        raw = await redis_module.redis_client.get(key)
+        if raw:
+            prev = MergedSub(**json.loads(raw))
+            if time.time() - prev.fetched_at < settings.SUB_CACHE_TTL:
+                return prev
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_build(uuid, links, prev, user_agent))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+
+    sub = await asyncio.shield(task)
+    return sub or prev
+
+
+def not_modified(sub: MergedSub, if_none_match: str | None, if_modified_since: str | None) -> bool:
+    """Условный запрос клиента совпал с текущей версией"""
+    if if_none_match is not None:
+        tags = {tag.strip() for tag in if_none_match.split(",")}
+        return "*" in tags or sub.etag in tags or f"W/{sub.etag}" in tags
+
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(sub.last_modified)
+        except (TypeError, ValueError):
+            return False
+    return False
@@ -0,0 +1,194 @@
+import asyncio
+import time
+from dataclasses import replace
+
+import orjson
+from redis.exceptions import WatchError
+
+import app.redis_client as redis_module
+from config_data.config import settings
+from logger_setup import logger
+from marz.backend import MarzbanClient
+from misc import broadcast, read_model, versions
+from misc.lru import LRUCache
+from misc.read_model import LinksSub, project
+
+
+# Сброс кэша пользователя во всех воркерах
+USERS_CHANNEL = "users:invalidate"
+# Hash с проекцией пользователя (поля LinksSub + at)
+CACHE_PREFIX = "marzban:proj:"
+# Пометка "данные устарели по событию" - перед выдачей нужно перечитать
+DIRTY_PREFIX = "marzban:proj:dirty:"
+# Поколение пользователя: растёт при каждом invalidate. Чтение, начатое
+# до сброса, свой результат в кэш уже не пишет
+GEN_PREFIX = "marzban:proj:gen:"
+
+
+def _to_hash(sub: LinksSub) -> dict[str, str]:
+    return {
+        "at": str(time.time()),
+        "sub_link": sub.sub_link,
+        "links": orjson.dumps(sub.links).decode(),
+        "titles": orjson.dumps(sub.titles).decode(),
+        "expire": "" if sub.expire is None else str(sub.expire),
+        "status": sub.status or "",
+    }
+
+
+def _from_hash(data: dict[str, str]) -> LinksSub:
+    return LinksSub(
+        sub_link=data["sub_link"],
+        links=orjson.loads(data["links"]),
+        titles=orjson.loads(data["titles"]),
+        expire=int(data["expire"]) if data["expire"] else None,
+        status=data.get("status") or None,
+    )
+
+
+# Первый уровень: память процесса, второй - Redis
+_local = LRUCache(maxsize=settings.USER_CACHE_LOCAL_SIZE, ttl=settings.USER_CACHE_LOCAL_TTL)
+
+# Идущие запросы к панели: один на пользователя в процессе
+_inflight: dict[str, asyncio.Task] = {}
+
+
+async def _fetch(user_id: str) -> LinksSub | None:
+    '''
+    Источник - локальная модель (misc.read_model), её держат в актуальном
+    состоянии вебхуки Marzban. К панели идём, только если пользователя
+    там ещё нет, и сохраняем ответ в модель.
+    Пишет проекцию в оба уровня кэша, если за время чтения не было
+    invalidate (поколение не изменилось) - иначе результат только отдаётся.
+    None - данных нет, старое значение в кэше не трогаем.
+    '''
+    redis = redis_module.redis_client
+    gen_key = GEN_PREFIX + user_id
+    gen = await redis.get(gen_key) if redis is not None else None
+
+    sub = await read_model.get(user_id)
+    if sub is None:
+        version = versions.now()
+        res = await MarzbanClient(settings.M_DIGITAL_URL, max_attempts=settings.USER_CACHE_FETCH_ATTEMPTS).get_user(user_id)
+        sub = project(res) if res else None
+        if sub is None:
+            return None
+        sub.version = version
+        await read_model.save({user_id: sub})
+
+    if redis is not None:
+        key = CACHE_PREFIX + user_id
+        try:
+            async with redis.pipeline(transaction=True) as pipe:
+                await pipe.watch(gen_key)
+                if await pipe.get(gen_key) != gen:
+                    logger.debug(f"Кэш {user_id} сброшен во время чтения, не пишем")
+                    return sub
+                pipe.multi()
+                pipe.delete(key)
+                pipe.hset(key, mapping=_to_hash(sub))
+                pipe.expire(key, settings.USER_CACHE_STALE_TTL)
+                pipe.delete(DIRTY_PREFIX + user_id)
+                await pipe.execute()
+        except WatchError:
+            logger.debug(f"Кэш {user_id} сброшен во время записи, не пишем")
+            return sub
+    _local.set(user_id, sub)
+    return sub
+
+
+def _log_refresh_error(user_id: str, task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception():
+        logger.warning(f"Фоновое обновление {user_id} не удалось: {task.exception()}")
+
+
+def refresh(user_id: str) -> asyncio.Task:
+    """Запрос к панели с объединением: параллельные вызовы ждут один и тот же"""
+    task = _inflight.get(user_id)
+    if task is None:
+        task = _inflight[user_id] = asyncio.create_task(_fetch(user_id))
+        task.add_done_callback(lambda _: _inflight.pop(user_id, None))
+    return task
+
+
+async def get(user_id: str) -> LinksSub | None:
+    '''
+    Проекция пользователя Marzban основной панели:
+    память процесса -> Redis -> панель.
+
+    Свежая запись (моложе USER_CACHE_TTL) отдаётся сразу.
+    Старая - тоже сразу, со stale=True, а в фоне идёт обновление.
+    После invalidate или без записи ждём панель не дольше
+    USER_CACHE_REFRESH_WAIT; не дождались - отдаём последнее хорошее
+    значение со stale=True, пока оно есть (хранится USER_CACHE_STALE_TTL).
+    '''
+    user_id = str(user_id)
+    res = _local.get(user_id)
+    if res is not None:
+        return res
+
+    redis = redis_module.redis_client
+    if redis is None:
+        logger.error("❌ redis_client is None!")
+        return await refresh(user_id)
+
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hgetall(CACHE_PREFIX + user_id)
+        pipe.exists(DIRTY_PREFIX + user_id)
+        data, dirty = await pipe.execute()
+    cached = _from_hash(data) if data else None
+
+    if cached is not None and not dirty:
+        if time.time() - float(data["at"]) < settings.USER_CACHE_TTL:
+            logger.debug(f"✓ Cache hit для {user_id}")
+            _local.set(user_id, cached)
+            return cached
+        logger.debug(f"~ Cache stale для {user_id}, обновляем в фоне")
+        # Результат никто не ждёт - ошибку забирает и логирует колбэк
+        refresh(user_id).add_done_callback(lambda task: _log_refresh_error(user_id, task))
+        return replace(cached, stale=True)
+
+    logger.debug(f"✗ Cache miss для {user_id}")
+    try:
+        res = await asyncio.wait_for(asyncio.shield(refresh(user_id)), timeout=settings.USER_CACHE_REFRESH_WAIT)
+    except asyncio.TimeoutError:
+        res = None
+    except Exception as e:
+        logger.warning(f"Не удалось получить пользователя {user_id}: {e}")
+        res = None
+
+    if res is None and cached is not None:
+        logger.warning(f"Панель не ответила, отдаём старые данные {user_id}")
+        return replace(cached, stale=True)
+    return res
+
+
+async def invalidate(*user_ids: str | int) -> None:
+    '''
+    Пометить кэш пользователей устаревшим в Redis и сбросить в памяти всех
+    воркеров. Последнее хорошее значение остаётся на случай падения панели.
+    '''
+    user_ids = tuple(str(user_id) for user_id in user_ids)
+    if not user_ids:
+        return
+    for user_id in user_ids:
+        _local.pop(user_id)
+
+    redis = redis_module.redis_client
+    if redis is None:
+        return
+    async with redis.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.incr(GEN_PREFIX + user_id)
+            pipe.expire(GEN_PREFIX + user_id, settings.USER_CACHE_STALE_TTL)
+            pipe.set(DIRTY_PREFIX + user_id, "1", ex=settings.USER_CACHE_STALE_TTL)
+        await pipe.execute()
+    await broadcast.publish(USERS_CHANNEL, orjson.dumps(user_ids).decode())
+
+
+async def _on_invalidate(message: str) -> None:
+    for user_id in orjson.loads(message):
+        _local.pop(user_id)
+
+
+broadcast.subscribe(USERS_CHANNEL, _on_invalidate)
@@ -1,8 +1,6 @@
-from urllib.parse import unquote
-from dataclasses import dataclass
 from repositories.base import BaseRepository
 from db.database import async_session
-from db.db_models import UserOrm, LinksOrm
+from db.db_models import UserOrm, LinksOrm, UserPanelLinkOrm
 from datetime import datetime
 from misc.bot_setup import add_monthes
 from datetime import timedelta
@@ -10,63 +8,15 @@ from logger_setup import logger
 import uuid
 from marz.backend import MarzbanClient
 from config_data.config import settings
-import json
-import app.redis_client as redis_module
+from misc import routing, user_cache
+from misc.user_cache import LinksSub
+from marz import panels
 
 MONTH = 30
 
-@dataclass(slots=True)
-class LinksSub:
-    sub_link: str
-    links: list
-    titles: list
-
-
-async def to_link(lst_data: dict):
-    links = lst_data.get("links")
-    if links is None:
-        return False
-    
-    titles = []
-    for link in links:
-        sta = link.find("#")
-        encoded = link[sta+1:]
-        text = unquote(encoded)
-        titles.append(text)
-    
-    sub_link = lst_data.get('subscription_url')
-    if sub_link is None:
-        return None
-
-    return LinksSub(
-        sub_link=sub_link,
-        links=links,
-        titles=titles
-    )
-
-async def get_user_cached(user_id: str, ttl: int = 300) -> dict | None:
-    """Получить пользователя с кэшированием на 5 минут"""
-    backend = MarzbanClient(settings.M_DIGITAL_URL)
-
-    if redis_module.redis_client is None:
-        logger.error("❌ redis_client is None!")
-        return await backend.get_user(user_id)
-    
-    cache_key = f"marzban:user:{user_id}"
-    
-    cached = await redis_module.redis_client.get(cache_key)
-    
-    if cached:
-        logger.debug(f"✓ Cache hit для {user_id}")
-        return json.loads(cached)
-    
-    logger.debug(f"✗ Cache miss для {user_id}")
-    res = await backend.get_user(user_id)
-    
-    if res:
-        await redis_module.redis_client.set(cache_key, json.dumps(res), ex=ttl)
-
-    return res
+async def get_user_cached(user_id: str) -> LinksSub | None:
+    """Ссылки и названия подписки пользователя через кэш (misc.user_cache)"""
+    return await user_cache.get(user_id)
 
 
 async def get_user(user_id) -> UserOrm | None:
@@ -95,12 +45,22 @@ async def get_user_in_links(user_id) -> LinksOrm | None:
         return res
     
 
-async def get_links_of_panels(uuid: str) -> list | None:
+async def get_links_of_panels(uuid: str) -> dict | None:
     '''
     Эта функция принимает на вход uuid строку. 
-    И возвращает списоков подписок для обеих панелей, 
-    которые есть в таблице links для этого uuid.
+    И возвращает словарь {панель: ссылка подписки} для всех панелей, 
+    которые есть у этого uuid в links/user_panel_links.
+    Сначала смотрит таблицу маршрутов в памяти, в БД идёт только при промахе
+    и только если uuid может существовать по bloom-фильтру.
     '''
+    links = routing.lookup(uuid)
+    if links is not None:
+        return links
+
+    if not await routing.may_exist(uuid):
+        logger.debug(f'uuid {uuid} отсечён фильтром')
+        return None
+
     async with async_session() as session:
         user_repo = BaseRepository(session=session, model=LinksOrm)
         res = await user_repo.get_one(uuid=uuid)
@@ -108,9 +68,24 @@ async def get_links_of_panels(uuid: str) -> list | None:
 
         if res is None:
             return None
-        return [res.panel_1, res.panel_2]
+        rows = await BaseRepository(session=session, model=UserPanelLinkOrm).list(user_id=res.user_id)
+        links = routing.merge_links(res, rows)
+        routing.put(res.uuid, links)
+        return links
     
 
+def primary_panel_name(sub_url: str) -> str:
+    '''
+    Панель для ссылки основной панели (M_DIGITAL_URL) нового пользователя.
+    Без PANELS в настройках - прежнее правило: 'world' в адресе - panel_1,
+    иначе panel_2. С реестром - панель по адресу ссылки.
+    '''
+    if panels.names() == list(panels.LEGACY_COLUMNS):
+        return "panel_1" if sub_url.find("world") != -1 else "panel_2"
+    panel = panels.for_url(sub_url) or panels.for_url(settings.M_DIGITAL_URL)
+    return panel.name if panel else panels.names()[0]
+
+
 async def modify_user(username):
     username = str(username)
     backend = MarzbanClient(url=settings.M_DIGITAL_URL)
@@ -133,14 +108,15 @@ async def modify_user(username):
             }
             sub_url = user['subscription_url'] #type: ignore
             logger.debug(f"DATA PANEL: {data_panel}")
-            if sub_url.find("world") != -1:
-                data_panel["panel_1"] = sub_url
-            else:
-                data_panel["panel_2"] = sub_url
+            panel_name = primary_panel_name(sub_url)
+            if panel_name in panels.LEGACY_COLUMNS:
+                data_panel[panel_name] = sub_url
             logger.debug(f"DATA PANEL AFTER: {data_panel}")
             res = await repo.create(data_panel)
             logger.debug(res)
 
+        await accept_panel(new_link={panel_name: sub_url}, username=username)
+
         await backend.modify_user(
             user_id=username,
             expire=0
@@ -160,7 +136,7 @@ def new_date(expire: datetime, amount: str):
 def calculate_expire(old_expire):
     current_time = datetime.now()
     
-    old_expire = datetime.fromtimestamp(old_expire)
+    old_expire = datetime.fromtimestamp(old_expire) if old_expire else None
     if old_expire is None:
         new_expire = current_time
     elif old_expire >= current_time:
@@ -197,116 +173,61 @@ async def get_sub_url(user_id):
     return res
 
 
-async def accept_panel(new_link: dict, username: str):
-        logger.debug("Зашли в редактор БД")
-        try:
-            async with async_session() as session:
-                repo = BaseRepository(session=session, model=LinksOrm)
-                logger.debug(f'{"="*15} Репо создан {"="*15}')
-                base_res = await repo.update_where(
-                        data=new_link, 
-                        user_id=username)
-                logger.debug(f'Новая запись {base_res}')
-        except Exception as e:
-            logger.error(f'Ошибка при добавленни ссылки в БД {e}')
-            raise ValueError
-    
-
-
-async def create_user_sync(data):
+async def save_links(new_links: dict[str, dict[str, str]]) -> None:
     '''
-    Эта функция создаёт пользователя в Marzban принимая на вход
-    данные из запроса от самого Marzban и перенаправляя его в другую 
-    панель
+    Сохраняет ссылки сразу многих пользователей {username: {панель: ссылка}}
+    одной транзакцией: upsert в user_panel_links и, для panel_1/panel_2,
+    колонки в links. После записи рассылает обновлённые маршруты всем воркерам.
     '''
+    new_links = {username: links for username, links in new_links.items() if links}
+    if not new_links:
+        return
 
-    username = data[0]['username']
-
-    pan = data[0]["user"]["subscription_url"]
-    logger.debug(f'Пришёл запрос от Marzban с панели: {pan[:15]}')
-
-    pan1 = False
-
-    if pan.find("dns1") != -1: # Если в панели есть dns1 - значит это первая панель
-        backend = MarzbanClient(settings.DNS2_URL)
-        pan1 = True
-    else:
-        backend = MarzbanClient(settings.DNS1_URL)
-
-
-    inbounds = data[0]['user']['inbounds']['vless']
-    id =       data[0]['user']['proxies']['vless']['id']
-    expire =   data[0]['user']['expire']
-
-    logger.debug(f'Данные пользователя: username --- {username} --- inbounds {inbounds} --- id {id}')
-    try:
-        res = await backend.create_user_options(username=username, id=id, inbounds=inbounds, expire=expire)
-
-        if res is None:
-            return {"error": 'При создании пользоваетеля возникла ошибка'}
-        
-        if res['status'] == 409:
-            return {"msg": "тут нечего делать"}
-            
-        logger.debug(f'Создан пользователь: {res["username"]}') 
-
-        new_link = dict()
-        if pan1:
-            new_link['panel_2'] = res["subscription_url"]
-        else:
-            new_link['panel_1'] = res["subscription_url"]
-        
-        logger.debug(f"Данные для бд {'='*15} {new_link} : {username}")
-
-        # Добавляем в бд запись о новой ссылке
-        await accept_panel(new_link=new_link, username=username)
-
-    except ValueError:
-        logger.error('Не получилось получить вторую ссылку')
-    except Exception as e:
-        logger.error(f'Возникла ошибка: {e}')
-
-
-async def update_user_sync(data):
-    '''
-    Эта функция создаёт пользователя в Marzban принимая на вход
-    данные из запроса от самого Marzban и перенаправляя его в другую 
-    панель
-    '''
-    username = data[0]['username']
-
-    pan = data[0]["user"]["subscription_url"]
-    logger.debug(f'Пришёл запрос от Marzban с панели: {pan[:15]}')
+    async with async_session() as session:
+        repo = BaseRepository(session=session, model=LinksOrm)
+        links_repo = BaseRepository(session=session, model=UserPanelLinkOrm)
+
+        existing = {link.user_id: link for link in await repo.list(user_id__in=list(new_links))}
+
+        await repo.bulk_update([
+            {"user_id": username, **{k: v for k, v in links.items() if k in panels.LEGACY_COLUMNS}}
+            for username, links in new_links.items()
+            if username in existing and any(k in panels.LEGACY_COLUMNS for k in links)
+        ], commit=False)
+        await links_repo.upsert_many(
+            [
+                {"user_id": username, "panel": panel, "sub_url": url}
+                for username, links in new_links.items() if username in existing
+                for panel, url in links.items()
+            ],
+            index_elements=["user_id", "panel"],
+            update_fields=["sub_url"],
+            commit=False,
+        )
+        await session.commit()
 
-    pan1 = False
+        missing = set(new_links) - set(existing)
+        if missing:
+            logger.warning(f'Нет записи в links для {sorted(missing)}, ссылки не сохранены')
 
-    if pan.find("dns1") != -1: # Если в панели есть dns1 - значит это первая панель
-        backend = MarzbanClient(settings.DNS2_URL)
-        pan1 = True
-    else:
-        backend = MarzbanClient(settings.DNS1_URL)
+        # После commit объекты протухли - перечитываем обе таблицы разом
+        saved = await repo.list(user_id__in=list(existing))
+        rows = await links_repo.list(user_id__in=list(existing))
+        by_user: dict[str, list] = {}
+        for row in rows:
+            by_user.setdefault(row.user_id, []).append(row)
 
-    expire =   data[0]['user']['expire']
+        for link in saved:
+            await routing.publish(link.uuid, routing.merge_links(link, by_user.get(link.user_id, [])))
 
-    try:
-        res = await backend.modify_user(user_id=username, expire=expire)
 
-        if res is None:
-            return {"error": 'При создании пользоваетеля возникла ошибка'}
-        
-        new_link = dict()
-        if pan1:
-            new_link['panel_2'] = res["subscription_url"]
-        else:
-            new_link['panel_1'] = res["subscription_url"]
-        
-        logger.debug(f"Данные для бд {'='*15} {new_link} : {username}")
-
-        # Добавляем в бд запись о новой ссылке
-        await accept_panel(new_link=new_link, username=username)
-
-    except ValueError:
-        logger.error('Не получилось получить вторую ссылку')
-    except Exception as e:
-        logger.error(f'Возникла ошибка: {e}')
-    
\ No newline at end of file
+async def accept_panel(new_link: dict, username: str):
+        '''
+        Сохраняет ссылки одного пользователя {панель: ссылка}.
+        '''
+        logger.debug("Зашли в редактор БД")
+        try:
+            await save_links({username: new_link})
+        except Exception as e:
+            logger.error(f'Ошибка при добавленни ссылки в БД {e}')
+            raise ValueError
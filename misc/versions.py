@@ -0,0 +1,20 @@
+import time
+
+
+# Версия состояния пользователя для записей из нескольких консумеров:
+# строка в БД перезаписывается только состоянием не старше текущего.
+# Версия = мс << 16 | номер: id записи стрима Redis ("<мс>-<номер>")
+# и текущее время дают сравнимые числа.
+SEQ_BITS = 16
+# Поле события Marzban с его версией (ставят stream._decode и process_batch)
+EVENT_FIELD = "_version"
+
+
+def from_stream_id(entry_id: str) -> int:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms) << SEQ_BITS | min(int(seq or 0), (1 << SEQ_BITS) - 1)
+
+
+def now() -> int:
+    """Версия для записей вне стрима (оплата, сверка, чтение панели)"""
+    return int(time.time() * 1000) << SEQ_BITS
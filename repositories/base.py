@@ -3,6 +3,7 @@ from __future__ import annotations
 
 from typing import Any, Generic, Iterable, Sequence, TypeVar, overload
 from sqlalchemy import select, delete, update, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import Select
@@ -125,6 +126,36 @@ class BaseRepository(Generic[T]):
         # refresh для пачки обычно не нужен, если нет server_defaults
         return objs
 
+    async def upsert_many(
+        self,
+        rows: Sequence[dict[str, Any]],
+        *,
+        index_elements: Sequence[str],
+        update_fields: Sequence[str],
+        set_: dict[str, Any] | None = None,
+        where: Any | None = None,
+        commit: bool = True,
+    ) -> int:
+        """
+        INSERT ... ON CONFLICT (index_elements) DO UPDATE SET update_fields.
+        Одним запросом. Возвращает кол-во затронутых строк.
+        set_ - свои выражения для SET (можно ссылаться на insert(model).excluded).
+        where - условие ON CONFLICT DO UPDATE: строки, где оно ложно, не меняются.
+        commit=False - оставить в текущей транзакции.
+        """
+        if not rows:
+            return 0
+        stmt = insert(self.model).values(list(rows))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(index_elements),
+            set_={**{field: stmt.excluded[field] for field in update_fields}, **(set_ or {})},
+            where=where,
+        )
+        res = await self.session.execute(stmt)
+        if commit:
+            await self.session.commit()
+        return res.rowcount or 0 # type:ignore
+
     async def get_by_id(self, pk: Any) -> T | None:
         return await self.session.get(self.model, pk)
 
@@ -198,6 +229,17 @@ class BaseRepository(Generic[T]):
         await self.session.commit()
         return res.rowcount or 0 # type:ignore
 
+    async def bulk_update(self, rows: Sequence[dict[str, Any]], *, commit: bool = True) -> None:
+        """
+        Массовое обновление по первичному ключу: в каждой строке PK + поля.
+        commit=False - оставить в текущей транзакции.
+        """
+        if not rows:
+            return
+        await self.session.execute(update(self.model), list(rows))
+        if commit:
+            await self.session.commit()
+
     async def delete(self, pk: Any) -> bool:
         pk_col = getattr(self.model, self.pk_attr)
         stmt = delete(self.model).where(pk_col == pk).returning(pk_col)
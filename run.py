@@ -1,9 +1,12 @@
+import argparse
+import os
+
 from granian import Granian
 from granian.constants import Loops, Interfaces
 
 
-if __name__ == "__main__":
-    Granian(
+def dev() -> Granian:
+    return Granian(
         target="app.main:app",
         address="127.0.0.1",
         port=8000,
@@ -12,4 +15,31 @@ if __name__ == "__main__":
         log_enabled=True,
         interface=Interfaces.ASGI,
         reload=True
-    ).serve()
\ No newline at end of file
+    )
+
+
+def prod() -> Granian:
+    """Несколько воркеров, uvloop/rloop, параметры из Settings"""
+    from config_data.config import settings
+
+    return Granian(
+        target="app.main:app",
+        address=settings.WEB_HOST,
+        port=settings.WEB_PORT,
+        workers=settings.WEB_WORKERS or os.cpu_count() or 1,
+        loop=Loops(settings.WEB_LOOP),
+        backlog=settings.WEB_BACKLOG,
+        runtime_threads=settings.WEB_RUNTIME_THREADS,
+        blocking_threads=settings.WEB_BLOCKING_THREADS,
+        log_enabled=True,
+        interface=Interfaces.ASGI,
+        respawn_failed_workers=True,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prod", action="store_true", help="продакшн профиль вместо dev с reload")
+    args = parser.parse_args()
+
+    (prod() if args.prod else dev()).serve()
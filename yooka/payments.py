@@ -1,4 +1,6 @@
 from yookassa import Payment, Configuration
+from yookassa.domain.exceptions import NotFoundError
+import asyncio
 import uuid
 import json
 from config_data.config import settings
@@ -51,4 +53,17 @@ class PaymentYoo:
         except Exception as e:
             logger.warning(f'Ошибка создания платежа: {e}')
 
-        return None
\ No newline at end of file
+        return None
+
+
+async def find_payment(payment_id: str) -> dict | None:
+    '''
+    Платёж из API YooKassa по id: уведомлению на /pay не верим,
+    статус и сумму берём отсюда. None - такого платежа нет.
+    SDK синхронный, запрос идёт в потоке.
+    '''
+    try:
+        payment = await asyncio.to_thread(Payment.find_one, payment_id)
+    except NotFoundError:
+        return None
+    return json.loads(payment.json())